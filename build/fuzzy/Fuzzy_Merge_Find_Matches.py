@@ -13,14 +13,18 @@
 from __future__ import print_function
 
 from util.serialization import safe_deserialize, retrieve_linker, parse_missing_fields, \
-    df_to_dict, get_list_chunks, get_list_chunks_fixedsize
+    df_to_dict, get_list_chunks
+from util.match_store import get_match_store_path, get_record_fingerprints, has_same_good_data, \
+    get_reusable_matches, write_match_shard, read_match_shard, load_matched_ids
 from dedupe.predicates import StringPredicate, commonSixGram
 from dedupe.blocking import Blocker
 
 from multiprocessing import Pool
 from tqdm import *
+from itertools import chain
 
 import os
+import time
 import argparse
 import pandas as pd
 import cloudpickle
@@ -30,6 +34,9 @@ import getpass
 import sys
 import logging
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from stage_timer import stage_timer
+
 
 # Prepass settings (i.e. manual blocking on field groups)
 prepass_rounds = {
@@ -49,6 +56,13 @@ prepass_rounds = {
 }
 
 
+# Number of candidate pairs scored per linker call in the prepass
+prepass_chunk_size = 50000
+
+# Target number of candidate pairs per full-pass task
+fullpass_batch_size = 20000
+
+
 # Utility function to concatenate matched data
 def concatenate_matches(bad_data, good_data, linked_records, save_domicile=False):
 
@@ -144,52 +158,77 @@ def concatenate_matches(bad_data, good_data, linked_records, save_domicile=False
     return pd.DataFrame(final_rows)
 
 
-# Utility to run the logistic model for the prepass
-def find_prepass_matches(group, fields_list, linker, round_number=0):
+# Utility to pick the most likely candidate in each group of scored pairs
+def get_best_candidates(group_starts, match_probabilities):
     """
-    Finds matches in the prepass stage using the same logistic regression model
-    as the main matching procedure.
+    Given the match probabilities of consecutive groups of candidate pairs (each group
+    starting at the corresponding entry of group_starts), returns the row of the most
+    likely candidate in each group (the first one in case of ties) and its probability.
+    """
+    n = len(match_probabilities)
+    group_sizes = np.diff(np.r_[group_starts, n])
+    best_probabilities = np.maximum.reduceat(match_probabilities, group_starts)
+    is_best = match_probabilities == np.repeat(best_probabilities, group_sizes)
+    best_rows = np.minimum.reduceat(np.where(is_best, np.arange(n), n), group_starts)
+    return best_rows, best_probabilities
+
+
+# Utility to get the columns of the prepass candidate pairs used by the logistic model
+def get_prepass_columns(fields_list, linker):
+    """
+    Returns the columns of the bad and good datapoints of the prepass candidate pairs
+    that are passed on to the linker (the good datapoints' own copies of the fields not
+    used for blocking carry the suffix _u).
     """
-    # Get record sets
     linker_fields = [x.field for x in linker.data_model.primary_fields]
     gdata_cols = [x + "_u" for x in set(linker_fields)
             - set(fields_list)] + ['good_data_id']
     bdata_cols = linker_fields + ['bad_data_id']
-    bdata = parse_missing_fields(df_to_dict(group[bdata_cols].head(1)))
-    gdata_df = group[fields_list + gdata_cols].rename(columns={x:x.replace("_u", "") for x in gdata_cols})
-    gdata_df.index += 1
+    return bdata_cols, gdata_cols
+
+
+# Utility to score a chunk of prepass candidate pairs with the logistic model
+def score_prepass_pairs(pairs, fields_list, linker):
+    """
+    Computes the match probabilities of a chunk of prepass candidate pairs (one row per
+    pair of bad and good datapoints), using the same logistic regression model as the
+    main matching procedure. Returns an array of probabilities in row order.
+    """
+    # Get record sets
+    bdata_cols, gdata_cols = get_prepass_columns(fields_list, linker)
+    pairs = pairs.reset_index(drop=True)
+    bdata_df = pairs[bdata_cols].drop_duplicates(subset=['bad_data_id'])
+    bdata_df.index = bdata_df.bad_data_id.values
+    bdata = parse_missing_fields(df_to_dict(bdata_df))
+    gdata_df = pairs[fields_list + gdata_cols].rename(columns={x:x.replace("_u", "") for x in gdata_cols})
     gdata = parse_missing_fields(df_to_dict(gdata_df))
-    bpoint = bdata[bdata.keys()[0]]
-    g_ids, gpoints = gdata.keys(), gdata.values()
 
     # Compute record distances
-    distances = linker.data_model.distances([(bpoint, gpoint) for gpoint in gpoints])
+    distances = linker.data_model.distances([(bdata[b_id], gdata[i])
+        for i, b_id in enumerate(pairs.bad_data_id.values)])
 
     # Compute match probabilities
-    match_probabilities = linker.classifier.predict_proba(distances)
+    return np.asarray(linker.classifier.predict_proba(distances), dtype=float)
 
-    # Return matches, if any
-    if np.max(match_probabilities) < acceptance_threshold:
-        return []
-    else:
-        best_match_index = g_ids[np.argmax(match_probabilities)]
-        best_match = gdata[best_match_index]["good_data_id"]
-        return [((bpoint["bad_data_id"], best_match), np.max(match_probabilities), round_number)]
 
+# Pool initializer for the prepass; sets the linker once per worker
+def init_prepass_worker(worker_linker):
+    global linker
+    linker = worker_linker
 
-# Utility to construct matches; make call to logistic model
-def run_prepass(fields_list, previous_matches, round_number, bad_data, good_data, linker):
 
-    # Get indices of previous matches
-    if len(previous_matches) > 0:
-        matched_good_data = [x[0][1] for x in previous_matches]
-        matched_bad_data = [x[0][0] for x in previous_matches]
-    else:
-        matched_bad_data, matched_good_data = [], []
+# Pool wrapper for score_prepass_pairs (uses the global linker)
+def score_prepass_chunk(args):
+    pairs, fields_list = args
+    return score_prepass_pairs(pairs, fields_list, linker)
+
+
+# Utility to construct matches; make call to logistic model
+def run_prepass(fields_list, matched_bad_ids, matched_good_ids, round_number, bad_data, good_data, linker, pool=None):
 
-    # Construct the hard matches
-    hard_matches = bad_data[~bad_data.bad_data_id.isin(matched_bad_data)].dropna(subset=fields_list).merge(
-        good_data[~good_data.good_data_id.isin(matched_good_data)].dropna(subset=fields_list),
+    # Construct the hard matches, excluding previously matched records
+    hard_matches = bad_data[~bad_data.bad_data_id.isin(matched_bad_ids)].dropna(subset=fields_list).merge(
+        good_data[~good_data.good_data_id.isin(matched_good_ids)].dropna(subset=fields_list),
         how="left",
         suffixes=("","_u"),
         on=fields_list
@@ -197,58 +236,110 @@ def run_prepass(fields_list, previous_matches, round_number, bad_data, good_data
     hard_matches.good_data_id = hard_matches.good_data_id.astype(int)
     hard_matches.bad_data_id = hard_matches.bad_data_id.astype(int)
 
-    # Run the logistic model
-    groups = hard_matches.groupby("bad_data_id")
-    prepass_links = []
-    for b_id, group in groups:
-        group_links = find_prepass_matches(group, fields_list, linker, round_number)
-        prepass_links.extend(group_links)
-    return prepass_links
+    if hard_matches.shape[0] == 0:
+        return []
 
+    # Score all candidate pairs of the round in chunks, in the worker pool if one is given;
+    # the chunks only carry the columns used by the linker
+    bdata_cols, gdata_cols = get_prepass_columns(fields_list, linker)
+    score_cols = bdata_cols + [x for x in fields_list + gdata_cols if x not in bdata_cols]
+    hard_matches = hard_matches[score_cols].sort_values("bad_data_id", kind="mergesort").reset_index(drop=True)
+    chunks = [(hard_matches.iloc[i:i + prepass_chunk_size], fields_list)
+        for i in range(0, hard_matches.shape[0], prepass_chunk_size)]
+    logger.info("Scoring {} candidate pairs in {} chunks".format(hard_matches.shape[0], len(chunks)))
+    if pool is not None and len(chunks) > 1:
+        match_probabilities = np.concatenate(pool.map(score_prepass_chunk, chunks))
+    else:
+        match_probabilities = np.concatenate([score_prepass_pairs(pairs, fields, linker) for pairs, fields in chunks])
 
-# Utility to run the logistic model for the prepass
-def find_fullpass_matches(blocks):
-    """
-    Finds matches in the full-pass stage.
-    """
-    fullpass_matches = []
-    fullpass_round_number = len(prepass_rounds)
+    # Pick the most likely match for each bad datapoint
+    bad_ids = hard_matches.bad_data_id.values
+    good_ids = hard_matches.good_data_id.values
+    group_starts = np.flatnonzero(np.r_[True, bad_ids[1:] != bad_ids[:-1]])
+    best_rows, best_probabilities = get_best_candidates(group_starts, match_probabilities)
 
-    for i, block in enumerate(blocks):
+    # Return matches above the acceptance threshold
+    accepted = np.flatnonzero(best_probabilities >= acceptance_threshold)
+    return [((int(bad_ids[best_rows[j]]), int(good_ids[best_rows[j]])), best_probabilities[j], round_number)
+        for j in accepted]
 
-        # Unpack the block
-        bdata, gdata = block
-        assert len(bdata) == 1, "Multiple bad datapoints in block. Did something go wrong in blocking?"
-        bdata_id, bpoint, _ = bdata[0]
-        gdata = {record[0]: record[1] for record in gdata}
-        g_ids, gpoints = gdata.keys(), gdata.values()
-
-        # Compute record distances
-        distances = linker.data_model.distances([(bpoint, gpoint) for gpoint in gpoints])
 
-        # Compute match probabilities
-        match_probabilities = linker.classifier.predict_proba(distances)
+# Pool initializer for the full pass; sets the linker and the good data once per worker
+def init_fullpass_worker(worker_linker, worker_threshold, worker_good_data):
+    global linker, acceptance_threshold, good_data_records
+    linker = worker_linker
+    acceptance_threshold = worker_threshold
+    good_data_records = worker_good_data
 
-        # Return matches, if any
-        if np.max(match_probabilities) < acceptance_threshold:
-            fullpass_matches.extend([])
-        else:
-            best_match = g_ids[np.argmax(match_probabilities)]
-            fullpass_matches.extend([((bdata_id, best_match), np.max(match_probabilities), fullpass_round_number)])
 
-        # Garbage collection and reporting
-        if i % 10 == 0:
-            logger.info("Processing block {}".format(i))
-        if i % 200 == 0:
-            gc.collect()
+# Utility to split the full-pass blocks into tasks of similar size
+def get_fullpass_batches(blocks, batch_size):
+    """
+    Groups the blocks into batches of at least batch_size candidate pairs. Good datapoints
+    are referenced by ID only; workers look them up in their copy of the good data.
+    """
+    batches, batch, batch_pairs = [], [], 0
+    for bdata, gdata in blocks:
+        assert len(bdata) == 1, "Multiple bad datapoints in block. Did something go wrong in blocking?"
+        bdata_id, bpoint, _ = bdata[0]
+        if len(gdata) == 0:
+            continue
+        batch.append((bdata_id, bpoint, [record[0] for record in gdata]))
+        batch_pairs += len(gdata)
+        if batch_pairs >= batch_size:
+            batches.append((len(batches), batch))
+            batch, batch_pairs = [], 0
+    if len(batch) > 0:
+        batches.append((len(batches), batch))
+    return batches
+
+
+# Utility to run the logistic model for the full pass
+def find_fullpass_matches(batch):
+    """
+    Finds matches in the full-pass stage for a batch of blocks, scoring all candidate
+    pairs of the batch with a single linker call. Returns the batch number, the matches
+    and the timing statistics of the batch.
+    """
+    start = time.time()
+    batch_number, batch_blocks = batch
+    fullpass_round_number = len(prepass_rounds)
 
-    return fullpass_matches
+    # Compute record distances and match probabilities
+    pairs = [(bpoint, good_data_records[g_id]) for _, bpoint, g_ids in batch_blocks for g_id in g_ids]
+    distances = linker.data_model.distances(pairs)
+    match_probabilities = np.asarray(linker.classifier.predict_proba(distances), dtype=float)
+
+    # Pick the most likely match for each block
+    block_sizes = [len(g_ids) for _, _, g_ids in batch_blocks]
+    group_starts = np.r_[0, np.cumsum(block_sizes)[:-1]]
+    best_rows, best_probabilities = get_best_candidates(group_starts, match_probabilities)
+    candidate_ids = list(chain.from_iterable(g_ids for _, _, g_ids in batch_blocks))
+    fullpass_matches = [((batch_blocks[j][0], candidate_ids[best_rows[j]]), best_probabilities[j], fullpass_round_number)
+        for j in np.flatnonzero(best_probabilities >= acceptance_threshold)]
+
+    stats = (os.getpid(), len(batch_blocks), len(pairs), time.time() - start)
+    return batch_number, fullpass_matches, stats
+
+
+# Utility to report full-pass throughput per worker and batch tail latency
+def log_fullpass_stats(stats):
+    if len(stats) == 0:
+        return
+    stats_df = pd.DataFrame(stats, columns=['pid', 'blocks', 'pairs', 'seconds'])
+    for pid, worker_stats in stats_df.groupby('pid'):
+        logger.info("Worker {}: {} batches, {} blocks, {} pairs in {:.1f}s ({:.0f} pairs/s)".format(
+            pid, worker_stats.shape[0], worker_stats.blocks.sum(), worker_stats.pairs.sum(),
+            worker_stats.seconds.sum(), worker_stats.pairs.sum() / max(worker_stats.seconds.sum(), 1e-9)))
+    latency = stats_df.seconds.quantile([0.5, 0.9, 0.99]).values
+    logger.info("Batch latency: p50 = {:.2f}s, p90 = {:.2f}s, p99 = {:.2f}s, max = {:.2f}s".format(
+        latency[0], latency[1], latency[2], stats_df.seconds.max()))
 
 
 # Multiprocessing mapper with progress bar
-def imap_unordered_bar(func, args, n_processes = 2):
+def imap_unordered_bar(func, args, n_processes = 2, initializer=None, initargs=()):
     logger.info("Starting multiprocessing pool with {} cores".format(num_cores))
-    p = Pool(n_processes)
+    p = Pool(n_processes, initializer=initializer, initargs=initargs)
     res_list = []
     with tqdm(total = len(args)) as pbar:
         for i, res in tqdm(enumerate(p.imap_unordered(func, args))):
@@ -275,6 +366,7 @@ if __name__ == "__main__":
     parser.add_argument("-f", "--fullpass", type=int, help="Whether to run full pass (i.e., attempt to match items that don't hard-match along any dimension")
     parser.add_argument("-b", "--simplefullpass", type=int, help="Boolean flag; replaces full pass predicates with a simple fuzzy predicate on securityname")
     parser.add_argument("-r", "--rmprevious", type=float, help="Whether to skip previously matched items (boolean flag)")
+    parser.add_argument("-i", "--incremental", type=int, default=0, help="Whether to only match records that are new or changed since the last run of this partition (boolean flag)")
 
     # Unpack the command line arguments
     args = parser.parse_args()
@@ -288,6 +380,7 @@ if __name__ == "__main__":
     do_full_pass = bool(args.fullpass)
     simple_full_pass = bool(args.simplefullpass)
     rm_previous = bool(args.rmprevious)
+    incremental = bool(args.incremental)
     mns_data_path = output_dir.replace("/output", "")
 
     # Set up logging
@@ -306,16 +399,17 @@ if __name__ == "__main__":
     logger.info("Partition {} beginning deserialization".format(partition))
     logger.info("Using {} cores".format(num_cores))
 
-    # Filter out previous matches as needed
-    match_ids_path = "{}/match_ids_{}_v{}".format(scratch_dir, asset_class, linker_version)
-    previous_matches = []
+    # Filter out previous matches (of other partitions) as needed
+    match_store_path = get_match_store_path(scratch_dir, asset_class, linker_version)
+    matched_bad_ids, matched_good_ids = set(), set()
     if rm_previous:
-        if not os.path.exists(match_ids_path):
+        if not os.path.exists(match_store_path):
             raise Exception("Asked to filter out previous matches but cannot find relevant records.")
-        for fname in os.listdir(match_ids_path):
-            with open(os.path.join(match_ids_path, fname), "rb") as f:
-                matches_shard = cloudpickle.load(f)
-            previous_matches += matches_shard
+        previous_bad_ids, previous_good_ids = load_matched_ids(match_store_path, exclude=(domicile, partition))
+        matched_bad_ids.update(previous_bad_ids.tolist())
+        matched_good_ids.update(previous_good_ids.tolist())
+        logger.info("Excluding {} previously matched bad and {} good datapoints".format(
+            len(previous_bad_ids), len(previous_good_ids)))
 
     # Deserialize the linker
     global linker
@@ -351,6 +445,25 @@ if __name__ == "__main__":
         predicates = [StringPredicate(commonSixGram, 'securityname')]
         linker.blocker = Blocker(predicates)
 
+    # Keep the previous matches of records that are unchanged since the last run of this partition
+    # (as long as the good data is unchanged as well)
+    bad_data_fingerprints = get_record_fingerprints(bad_data_chunk)
+    good_data_fingerprints = get_record_fingerprints(good_data_dict)
+    kept_matches = []
+    if incremental:
+        partition_matches, partition_index = read_match_shard(match_store_path, domicile, partition)
+        if partition_index is None:
+            logger.info("No previous run of partition {} found; matching all records".format(partition))
+        elif not has_same_good_data(partition_index, good_data_fingerprints):
+            logger.info("Good data changed since the last run of partition {}; matching all records".format(partition))
+        else:
+            kept_matches, skipped_ids = get_reusable_matches(partition_index, partition_matches,
+                bad_data_fingerprints, good_data_fingerprints)
+            matched_bad_ids.update(skipped_ids.tolist())
+            matched_good_ids.update(x[0][1] for x in kept_matches)
+            logger.info("Skipping {} unchanged bad datapoints ({} previous matches kept); matching {} new or changed ones".format(
+                len(skipped_ids), len(kept_matches), len(bad_data_chunk) - len(skipped_ids)))
+
     # Some more memory savings
     logger.info("Clearing memory")
     for k in good_data_dict.keys():
@@ -359,22 +472,27 @@ if __name__ == "__main__":
         bad_data_chunk[k].pop('securityname_raw')
 
     # Run the multiple rounds of prepass matching, iteratively deleting previous matches
+    # (with a single worker pool for all rounds)
+    prepass_pool = Pool(num_cores, initializer=init_prepass_worker, initargs=(linker,)) if num_cores > 1 else None
     prepass_matches = []
     for i, round_fields in enumerate(prepass_rounds[asset_class]):
         logger.info("Running prepass round {}".format(i))
-        current_round_matches = run_prepass(round_fields, prepass_matches + previous_matches,
-            round_number=i, bad_data=bad_data_df, good_data=good_data_df, linker=linker)
+        with stage_timer("run_prepass", logger, rows=(~bad_data_df.bad_data_id.isin(matched_bad_ids)).sum(),
+                round_number=i):
+            current_round_matches = run_prepass(round_fields, matched_bad_ids, matched_good_ids,
+                round_number=i, bad_data=bad_data_df, good_data=good_data_df, linker=linker, pool=prepass_pool)
         prepass_matches.extend(current_round_matches)
+        matched_bad_ids.update(x[0][0] for x in current_round_matches)
+        matched_good_ids.update(x[0][1] for x in current_round_matches)
+    if prepass_pool is not None:
+        prepass_pool.close()
+        prepass_pool.join()
 
     # Some reporting
     logger.info("Using prepass threshold {}, found a total of {} matches out of {} bad datapoints in shard".format(
         acceptance_threshold, len(prepass_matches), len(bad_data_chunk)
     ))
 
-    # Get indices of previous matches
-    matched_good_data = [x[0][1] for x in prepass_matches + previous_matches]
-    matched_bad_data = [x[0][0] for x in prepass_matches + previous_matches]
-
     # Run the matching process on the remaining unmatched data
     if do_full_pass:
 
@@ -385,25 +503,31 @@ if __name__ == "__main__":
         gc.collect()
 
         # Run the blocker
-        bad_data_chunk_unmatched = {k:v for k,v in bad_data_chunk.items() if k not in matched_bad_data}
-        good_data_dict_unmatched = {k:v for k,v in good_data_dict.items() if k not in matched_good_data}
+        bad_data_chunk_unmatched = {k:v for k,v in bad_data_chunk.items() if k not in matched_bad_ids}
+        good_data_dict_unmatched = {k:v for k,v in good_data_dict.items() if k not in matched_good_ids}
         logger.info("Running the blocker")
         blocks = linker._blockData(bad_data_chunk_unmatched, good_data_dict_unmatched)
 
-        # Run the linker
+        # Run the linker on batches of similar candidate-pair counts
         logger.info("Running the linker")
-        if num_cores > 1:
-            block_partitions = list(get_list_chunks_fixedsize(blocks, 1))
-            fullpass_matches = imap_unordered_bar(find_fullpass_matches, block_partitions, num_cores)
-        else:
-            fullpass_matches = [find_fullpass_matches(blocks)]
+        batches = get_fullpass_batches(blocks, fullpass_batch_size)
+        logger.info("Scoring {} blocks in {} batches".format(sum(len(x[1]) for x in batches), len(batches)))
+        fullpass_args = (linker, acceptance_threshold, good_data_dict_unmatched)
+        with stage_timer("find_fullpass_matches", logger) as stage:
+            if num_cores > 1:
+                fullpass_results = imap_unordered_bar(find_fullpass_matches, batches, num_cores,
+                    initializer=init_fullpass_worker, initargs=fullpass_args)
+            else:
+                init_fullpass_worker(*fullpass_args)
+                fullpass_results = [find_fullpass_matches(batch) for batch in batches]
+            stage['rows'] = sum(x[2][2] for x in fullpass_results)
+
+        # Flatten the output in batch order
+        fullpass_results = sorted(fullpass_results, key=lambda x: x[0])
+        fullpass_matches = list(chain.from_iterable(x[1] for x in fullpass_results))
+        log_fullpass_stats([x[2] for x in fullpass_results])
     else:
         fullpass_matches = []
-
-    # Flatten the output
-    if len(fullpass_matches) > 0:
-        flatten = lambda x, y: x + y
-        fullpass_matches = reduce(flatten, fullpass_matches)
     logger.info('Number of duplicate sets, post-prepass = {}'.format(len(fullpass_matches)))
 
     # Read in the standardized dataframes
@@ -411,8 +535,10 @@ if __name__ == "__main__":
         asset_class, domicile))
 
     # Concatenate the matches
-    matches = concatenate_matches(bad_data, good_data, prepass_matches + fullpass_matches,
-        save_domicile = True if domicile == "all" else False)
+    partition_matches = kept_matches + prepass_matches + fullpass_matches
+    with stage_timer("concatenate_matches", logger, rows=len(partition_matches)):
+        matches = concatenate_matches(bad_data, good_data, partition_matches,
+            save_domicile = True if domicile == "all" else False)
 
     # Save the matches
     match_partition_path = "{}/matches_partitioned_{}_{}_v{}".format(scratch_dir,
@@ -422,10 +548,8 @@ if __name__ == "__main__":
     matches.to_hdf("{}/matches_{}.h5".format(match_partition_path, partition), key="data")
 
     # Save the match IDs
-    if not os.path.exists(match_ids_path):
-        os.makedirs(match_ids_path)
-    with open("{}/match_ids_{}_{}.pkl".format(match_ids_path, domicile, partition), "wb") as f:
-        cloudpickle.dump(prepass_matches + fullpass_matches, f)
+    write_match_shard(match_store_path, domicile, partition, partition_matches, bad_data_fingerprints,
+        good_data_fingerprints)
 
     # Close logs
     sys.stderr.close()
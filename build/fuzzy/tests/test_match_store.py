@@ -0,0 +1,121 @@
+# --------------------------------------------------------------------------------------------------
+# Test_Match_Store
+#
+# Tests for the reuse of previous matches in incremental runs of Fuzzy_Merge_Find_Matches (see
+# util/match_store.py). Run from the fuzzy folder with: python -m unittest discover -s tests
+# --------------------------------------------------------------------------------------------------
+import os
+import sys
+import shutil
+import time
+import tempfile
+import unittest
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from util.match_store import get_record_fingerprints, has_same_good_data, get_unchanged_matches, \
+    get_reusable_matches, write_match_shard, read_match_shard
+
+
+# Synthetic security records, keyed by position
+def make_records(names):
+    return {i: {'securityname': name, 'coupon': 2.5, 'maturitydate': pd.Timestamp("2025-06-30")}
+        for i, name in enumerate(names)}
+
+
+class MatchStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.bad_data = make_records(["ACME CORP 2.5 25", "GLOBEX 2.5 25", "INITECH 2.5 25"])
+        self.good_data = make_records(["ACME CORP", "GLOBEX INC", "INITECH LLC", "UMBRELLA"])
+        self.matches = [((0, 0), 0.9, 0), ((1, 1), 0.8, 0), ((2, 2), 0.7, 4)]
+        write_match_shard(self.store_path, "us", 1, self.matches,
+            get_record_fingerprints(self.bad_data), get_record_fingerprints(self.good_data))
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def test_unchanged_data_keeps_matches(self):
+        matches, index = read_match_shard(self.store_path, "us", 1)
+        kept_matches, skipped_ids = get_reusable_matches(index, matches,
+            get_record_fingerprints(self.bad_data), get_record_fingerprints(self.good_data))
+        self.assertEqual(kept_matches, self.matches)
+        self.assertEqual(sorted(skipped_ids.tolist()), [0, 1, 2])
+
+    def test_changed_bad_record_is_matched_again(self):
+        self.bad_data[1]['coupon'] = 3.
+        matches, index = read_match_shard(self.store_path, "us", 1)
+        kept_matches, skipped_ids = get_reusable_matches(index, matches,
+            get_record_fingerprints(self.bad_data), get_record_fingerprints(self.good_data))
+        self.assertEqual(kept_matches, [self.matches[0], self.matches[2]])
+        self.assertEqual(sorted(skipped_ids.tolist()), [0, 2])
+
+    def test_reordered_good_data_invalidates_matches(self):
+
+        # Same good records in a different order: good IDs now refer to different securities
+        names = [self.good_data[i]['securityname'] for i in [3, 2, 1, 0]]
+        reordered_good_data = make_records(names)
+        matches, index = read_match_shard(self.store_path, "us", 1)
+        good_fingerprints = get_record_fingerprints(reordered_good_data)
+        self.assertFalse(has_same_good_data(index, good_fingerprints))
+        kept_matches, skipped_ids = get_reusable_matches(index, matches,
+            get_record_fingerprints(self.bad_data), good_fingerprints)
+        self.assertEqual(kept_matches, [])
+        self.assertEqual(len(skipped_ids), 0)
+
+        # Matches are also checked individually against the matched good records
+        self.assertEqual(get_unchanged_matches(index, matches, good_fingerprints), [])
+
+    def test_changed_or_missing_good_record_drops_match(self):
+        good_data = make_records([self.good_data[i]['securityname'] for i in range(4)])
+        good_data[1]['securityname'] = "GLOBEX CORP"
+        del good_data[2]
+        matches, index = read_match_shard(self.store_path, "us", 1)
+        self.assertEqual(get_unchanged_matches(index, matches, get_record_fingerprints(good_data)),
+            [self.matches[0]])
+
+    def test_index_without_good_fingerprints_reuses_nothing(self):
+        matches, index = read_match_shard(self.store_path, "us", 1)
+        index = {k: v for k, v in index.items() if k not in ['good_hashes', 'good_data_hash']}
+        kept_matches, skipped_ids = get_reusable_matches(index, matches,
+            get_record_fingerprints(self.bad_data), get_record_fingerprints(self.good_data))
+        self.assertEqual((kept_matches, len(skipped_ids)), ([], 0))
+
+
+class LargeMatchStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.bad_data = make_records(["SECURITY {} 2.5 25".format(i) for i in range(24000)])
+        self.good_data = make_records(["SECURITY {}".format(i) for i in range(30000)])
+        self.matches = [((i, i + 2000), 0.9, 0) for i in range(20000)]
+        write_match_shard(self.store_path, "us", 1, self.matches,
+            get_record_fingerprints(self.bad_data), get_record_fingerprints(self.good_data))
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def test_reuse_scales_to_large_shards(self):
+        for i in range(0, 24000, 7):
+            self.bad_data[i]['coupon'] = 3.
+        matches, index = read_match_shard(self.store_path, "us", 1)
+        start = time.time()
+        kept_matches, skipped_ids = get_reusable_matches(index, matches,
+            get_record_fingerprints(self.bad_data), get_record_fingerprints(self.good_data))
+        self.assertLess(time.time() - start, 5.)
+        self.assertEqual(kept_matches, [x for x in self.matches if x[0][0] % 7 > 0])
+        self.assertEqual(sorted(skipped_ids.tolist()), [i for i in range(24000) if i % 7 > 0])
+
+    def test_changed_good_records_scale_to_large_shards(self):
+        for i in range(0, 30000, 5):
+            self.good_data[i]['securityname'] += " NEW"
+        matches, index = read_match_shard(self.store_path, "us", 1)
+        start = time.time()
+        kept_matches = get_unchanged_matches(index, matches, get_record_fingerprints(self.good_data))
+        self.assertLess(time.time() - start, 5.)
+        self.assertEqual(kept_matches, [x for x in self.matches if x[0][1] % 5 > 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
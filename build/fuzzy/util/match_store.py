@@ -0,0 +1,192 @@
+# --------------------------------------------------------------------------------------------------
+# Match_Store
+#
+# All files in this folder (fuzzy) handle the probabilistic record linkage of observations in the
+# Morningstar holdings data for which we lack a CUSIP identifier to other observations for which we
+# do have an identifier. This allows us to assign a CUSIP to the former records via internal
+# cross-linkage.
+#
+# This file provides the persistent store of match IDs shared by the Fuzzy_Merge_Find_Matches jobs.
+# There is one store per asset class and linker version. Each partition only ever writes its own
+# shard, which consists of the list of matches (as before) and an index with sorted arrays of the
+# matched bad and good IDs, as well as fingerprints of all bad records processed by the partition,
+# of the matched good records and of the good data as a whole. Good IDs are positions in the good
+# data, so previous matches are only reused if the good data is unchanged.
+# --------------------------------------------------------------------------------------------------
+import os
+import hashlib
+import cloudpickle
+import numpy as np
+from .serialization import safe_deserialize
+
+
+# Location of the store for a given asset class and linker version
+def get_match_store_path(scratch_dir, asset_class, linker_version):
+    return "{}/match_ids_{}_v{}".format(scratch_dir, asset_class, linker_version)
+
+
+# Locations of the match list and index of a given partition
+def _get_shard_paths(store_path, domicile, partition):
+    return ("{}/match_ids_{}_{}.pkl".format(store_path, domicile, partition),
+            "{}/match_index_{}_{}.npz".format(store_path, domicile, partition))
+
+
+# Utility to split a shard filename into domicile and partition
+def _parse_shard_name(fname, prefix, suffix):
+    domicile, partition = fname[len(prefix):-len(suffix)].rsplit("_", 1)
+    return domicile, partition
+
+
+# Utility to fingerprint bad data records
+def get_record_fingerprints(records):
+    """
+    Returns the sorted record IDs and a 60-bit hash of the contents of each record,
+    used to detect new or changed records between runs.
+    """
+    ids = sorted(records.keys())
+    hashes = [int(hashlib.md5(repr(sorted(records[k].items())).encode("utf-8")).hexdigest()[:15], 16)
+        for k in ids]
+    return np.array(ids, dtype=np.int64), np.array(hashes, dtype=np.int64)
+
+
+# Utility to fingerprint a full dataset
+def get_data_fingerprint(fingerprints):
+    """
+    Returns a single hash of the IDs and contents of all records of a dataset, as
+    returned by get_record_fingerprints.
+    """
+    ids, hashes = fingerprints
+    return hashlib.md5(ids.tobytes() + hashes.tobytes()).hexdigest()
+
+
+# Utility to look up the fingerprints of given record IDs (-1 for missing records)
+def _lookup_hashes(ids, hashes, query_ids):
+    if len(ids) == 0:
+        return np.full(len(query_ids), -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(ids, query_ids), len(ids) - 1)
+    return np.where(ids[pos] == query_ids, hashes[pos], -1)
+
+
+# Utility to find the records that are unchanged since the last run
+def get_unchanged_ids(index, fingerprints):
+    """
+    Compares the fingerprints of the current records to those stored in a partition index
+    and returns the IDs of the records that have been processed before and are unchanged.
+    """
+    ids, hashes = fingerprints
+    return ids[_lookup_hashes(index['processed_ids'], index['processed_hashes'], ids) == hashes]
+
+
+# Utility to find the matches whose good record is unchanged since the last run
+def get_unchanged_matches(index, matches, good_fingerprints):
+    """
+    Returns the matches of a partition whose good record still exists with the same
+    contents as when the match was made.
+    """
+    matched_ids = np.array([x[0][1] for x in matches], dtype=np.int64)
+    prev_hashes = _lookup_hashes(index['good_ids'], index['good_hashes'], matched_ids)
+    current_hashes = _lookup_hashes(good_fingerprints[0], good_fingerprints[1], matched_ids)
+    unchanged = (prev_hashes == current_hashes) & (current_hashes > -1)
+    return [x for (x, keep) in zip(matches, unchanged) if keep]
+
+
+# Utility to check whether the good data is unchanged since the last run
+def has_same_good_data(index, good_fingerprints):
+    """
+    Returns whether the good data fingerprint stored in a partition index (if any)
+    matches that of the current good data.
+    """
+    return 'good_data_hash' in index and str(index['good_data_hash']) == get_data_fingerprint(good_fingerprints)
+
+
+# Utility to determine which previous matches of a partition can be reused
+def get_reusable_matches(index, matches, fingerprints, good_fingerprints):
+    """
+    Returns the previous matches that can be kept, along with the IDs of the bad records
+    that do not need to be matched again (unchanged records whose previous match, if any,
+    is kept). Nothing is reused if the good data has changed (or was not fingerprinted)
+    since the last run, as good IDs may then refer to different records and new good
+    records may provide better matches.
+    """
+    if not has_same_good_data(index, good_fingerprints):
+        return [], fingerprints[0][:0]
+    unchanged_ids = get_unchanged_ids(index, fingerprints)
+    unchanged = set(unchanged_ids.tolist())
+    previous_matches = [x for x in matches if x[0][0] in unchanged]
+    kept_matches = get_unchanged_matches(index, previous_matches, good_fingerprints)
+    dropped_ids = set(x[0][0] for x in previous_matches) - set(x[0][0] for x in kept_matches)
+    return kept_matches, unchanged_ids[np.isin(unchanged_ids, list(dropped_ids), invert=True)]
+
+
+# Write the shard of a given partition
+def write_match_shard(store_path, domicile, partition, matches, fingerprints, good_fingerprints):
+    """
+    Stores the matches of a partition along with its index. Files are written to a
+    temporary location first, so that concurrent readers never see partial shards.
+    """
+    if not os.path.exists(store_path):
+        try:
+            os.makedirs(store_path)
+        except OSError:
+            pass
+    list_path, index_path = _get_shard_paths(store_path, domicile, partition)
+
+    # Match list
+    with open(list_path + ".tmp", "wb") as f:
+        cloudpickle.dump(matches, f)
+    os.rename(list_path + ".tmp", list_path)
+
+    # Index
+    good_ids = np.unique(np.array([x[0][1] for x in matches], dtype=np.int64))
+    with open(index_path + ".tmp", "wb") as f:
+        np.savez(f,
+            bad_ids=np.unique(np.array([x[0][0] for x in matches], dtype=np.int64)),
+            good_ids=good_ids,
+            good_hashes=_lookup_hashes(good_fingerprints[0], good_fingerprints[1], good_ids),
+            good_data_hash=np.array(get_data_fingerprint(good_fingerprints)),
+            processed_ids=fingerprints[0],
+            processed_hashes=fingerprints[1])
+    os.rename(index_path + ".tmp", index_path)
+
+
+# Read the shard of a given partition
+def read_match_shard(store_path, domicile, partition):
+    """
+    Returns the matches and index of a partition, or (None, None) if the partition has
+    not been stored with an index yet.
+    """
+    list_path, index_path = _get_shard_paths(store_path, domicile, partition)
+    if not (os.path.exists(list_path) and os.path.exists(index_path)):
+        return None, None
+    with np.load(index_path) as data:
+        index = {k: data[k] for k in data.files}
+    return safe_deserialize(list_path), index
+
+
+# Load the matched IDs of all shards in the store
+def load_matched_ids(store_path, exclude=None):
+    """
+    Returns sorted arrays of all matched bad and good IDs in the store, skipping the
+    shard given by exclude (a (domicile, partition) tuple). Shards written before the
+    index was introduced are read from their match lists.
+    """
+    bad_ids, good_ids = [], []
+    exclude = None if exclude is None else (str(exclude[0]), str(exclude[1]))
+    fnames = os.listdir(store_path)
+    for fname in fnames:
+        if fname.startswith("match_index_") and fname.endswith(".npz"):
+            if _parse_shard_name(fname, "match_index_", ".npz") == exclude:
+                continue
+            with np.load(os.path.join(store_path, fname)) as data:
+                bad_ids.append(data['bad_ids'])
+                good_ids.append(data['good_ids'])
+        elif fname.startswith("match_ids_") and fname.endswith(".pkl"):
+            shard = _parse_shard_name(fname, "match_ids_", ".pkl")
+            if shard == exclude or "match_index_{}_{}.npz".format(*shard) in fnames:
+                continue
+            matches = safe_deserialize(os.path.join(store_path, fname))
+            bad_ids.append(np.array([x[0][0] for x in matches], dtype=np.int64))
+            good_ids.append(np.array([x[0][1] for x in matches], dtype=np.int64))
+    if len(bad_ids) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.unique(np.concatenate(bad_ids)), np.unique(np.concatenate(good_ids))
@@ -8,10 +8,24 @@
 # This jobs handles the actual unraveling of positions of funds investing in other funds. Where 
 # possible, positions are attributed to the ultimate holding fund, and the positions of the investing 
 # fund are scaled back accordingly.
+#
+# Notes:
+#   - With --buckets > 1, the merges are run separately for hash buckets of investing funds, so that
+#     the size of the merge intermediates depends on the bucket rather than on the period. The
+#     unwound positions of each bucket are spooled to disk as they are produced, and only the IDs
+#     and NAV shares needed for rescaling are kept in memory. The new positions are added to the
+#     outfiles once the period's positions have been released. The step51 files and rescaling lists
+#     are identical to those of the monolithic run; the xbr report is stored as one pickle per bucket
+#     (merging it would require the full report in memory), so it should be read in with
+#     read_xbr_report, which returns the same dataframe for either run.
+#   - With --lasttask, a range of tasks is processed in one run (e.g. on a small cluster without
+#     SLURM arrays). Each period is read once and kept in memory for the following task; with
+#     --workers > 1, the range is split into contiguous blocks processed in parallel.
 # --------------------------------------------------------------------------------------------------
 from __future__ import print_function
 from itertools import chain
 import distutils.dir_util
+import glob
 import pandas as pd
 import numpy as np
 import random
@@ -20,8 +34,14 @@ import argparse
 import logging
 import resource
 import gc
+import time
 import getpass
 import sys
+from multiprocessing import Pool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from stata_cache import read_stata_cached, log_cache_summary
+from stage_timer import stage_timer
 
 
 # Function to compute chronological markets
@@ -30,7 +50,7 @@ def get_chron_markers(taskid, firstyear, job_frequency):
     # Split the task into quarter-sized jobs
     if job_frequency == "q":
         year = firstyear + int(np.floor(taskid / 4))
-        period = taskid % 4 if (taskid % 4 != 0) else 4
+        period = taskid % 4 + 1
         prev_year = year if period > 1 else (year - 1)
         prev_period = 4 if period == 1 else (period - 1)
 
@@ -44,139 +64,55 @@ def get_chron_markers(taskid, firstyear, job_frequency):
     return year, period, prev_year, prev_period
 
 
-# Main routine
-if __name__ == "__main__":
-
-    # Parse command line arguments
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-t", "--taskid", type=int, help="Year for processing (as SLURM task ID)")
-    parser.add_argument("-d", "--datapath", type=str, help="MNS data path")
-    parser.add_argument("-f", "--firstyear", type=int, help="First year in dataset")
-    args = parser.parse_args()
-    mns_data = args.datapath
-    firstyear = args.firstyear
-    taskid = args.taskid
-    job_frequency = "h" # Hardcoded: q for quarterly; h for half-yearly
-    
-    # Set up logging
-    logger = logging.getLogger(__name__)
-    logfile = '{}/results/logs/{}_Unwind_MF_Positions_Step1_{}.log'.format(mns_data, getpass.getuser(), taskid)
-    if os.path.exists(logfile):
-        os.remove(logfile)
-    logging.basicConfig(filename=logfile, filemode='w', level=logging.DEBUG)
-    sys.stderr = open(logfile, 'a')
-    sys.stdout = open(logfile, 'a')
-    logging.info("Begin Unwinding_MF_Positions")
-
-    # Ensure relevant directories exist
-    distutils.dir_util.mkpath(os.path.join(mns_data, "temp/mf_unwinding/mf_xb_reassignments"))
-    distutils.dir_util.mkpath(os.path.join(mns_data, "temp/mf_unwinding/mf_scaling_lists"))
-    distutils.dir_util.mkpath(os.path.join(mns_data, "temp/mf_unwinding/hd_period_info"))
-
-    # Columns to be read in
-    usecols = ['MasterPortfolioId', 'iso_currency_code', 'date', 'iso_country_code',
-        'cusip', 'currency_id', 'marketvalue', 'mns_class', '_obs_id', 'lcu_per_usd_eop']
-
-    # Get chronological markers
-    year, period, prev_year, prev_period = get_chron_markers(taskid, firstyear, job_frequency)
+# Columns of the holding funds' positions carried through the unwinding merges
+holding_cols = ['cusip', 'MasterPortfolioId', 'investing_mpid', 'date', 'marketvalue',
+    'marketvalue_usd', 'currency_id', 'iso_country_code', '_obs_id', 'nonus']
 
-    # Report period
-    logger.warning("Running MF positions unwinding for year {}, {} = {}".format(year, job_frequency, period))
-
-    # Read in link table
-    logger.warning("Reading in the link table")
-    links = pd.read_stata(os.path.join(mns_data, 
-        "output/morningstar_api_data/Morningstar_API_Data_Link_Table.dta"))
-    links['_count'] = 1
-    link_counts = pd.DataFrame(links.groupby('cusip')['_count'].sum())
-    links = links[~links.cusip.isin(set(link_counts[link_counts['_count'] > 1].index))]
-    del links['_count']
-    del link_counts
-
-    # Load in the files
-    current_period_nonus = pd.read_stata(
-        os.path.join(mns_data, "temp/mf_unwinding/tmp_hd_files/NonUS_{}_{}{}_m_step4.dta".format(year, job_frequency, period)), columns=usecols)
-    current_period_us = pd.read_stata(
-        os.path.join(mns_data, "temp/mf_unwinding/tmp_hd_files/US_{}_{}{}_m_step4.dta".format(year, job_frequency, period)), columns=usecols)
-    prev_period_nonus = pd.read_stata(
-        os.path.join(mns_data, "temp/mf_unwinding/tmp_hd_files/NonUS_{}_{}{}_m_step4.dta".format(prev_year, job_frequency, prev_period)), columns=usecols)
-    prev_period_us = pd.read_stata(
-        os.path.join(mns_data, "temp/mf_unwinding/tmp_hd_files/US_{}_{}{}_m_step4.dta".format(prev_year, job_frequency, prev_period)), columns=usecols)
-
-    # Take special care of the first period (I verified there are no positions to be unwound)
-    if taskid == 1:
-        logger.warning("Processing primer period")
-        prev_period_nonus['mf_unwound'] = 0
-        prev_period_us['mf_unwound'] = 0
-        outcols = ["MasterPortfolioId", "_obs_id", "cusip", "date", "marketvalue", "mf_unwound"]
-        prev_period_nonus[outcols].to_stata(os.path.join(mns_data, "temp/mf_unwinding/hd_period_info/NonUS_{}_{}{}_m_step51.dta".format(year, job_frequency, 1)), write_index=False)
-        prev_period_us[outcols].to_stata(os.path.join(mns_data, "temp/mf_unwinding/hd_period_info/US_{}_{}{}_m_step51.dta".format(year, job_frequency, 1)), write_index=False)
-        del prev_period_nonus['mf_unwound']
-        del prev_period_us['mf_unwound']
-
-    logger.warning("Checkpoint 1")
-    logger.warning('Memory usage: %d (MB)' % (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024))
+# Sequence columns restoring the single-pass row order of the unwound positions
+bucket_seq_cols = ['_holding_seq', '_investing_seq']
 
-    # Concatenate
-    current_period_nonus['nonus'] = 1
-    current_period_us['nonus'] = 0
-    prev_period_nonus['nonus'] = 1
-    prev_period_us['nonus'] = 0
-    current_period = pd.concat([current_period_nonus, current_period_us], axis=0, sort=False)
-    prev_period = pd.concat([prev_period_nonus, prev_period_us], axis=0, sort=False)
-    current_period['current'] = 1
-    prev_period['current'] = 0
-    current_period_cols = set(current_period.columns)
 
-    # Perform currency conversion
-    current_period['marketvalue_usd'] = current_period['marketvalue'] / current_period['lcu_per_usd_eop']
-    prev_period['marketvalue_usd'] = prev_period['marketvalue'] / prev_period['lcu_per_usd_eop']
+# Function to assign investing funds to hash buckets
+def get_buckets(mpids, buckets):
+    """ Assigns each investing fund to one of the hash buckets used for streamed unwinding. All
+    positions of a given investing fund fall into the same bucket.
 
-    logger.warning("Checkpoint 2")
-    logger.warning('Memory usage: %d (MB)' % (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024))
+    Parameters:
+        mpids: Array of investing fund MasterPortfolioIds
+        buckets: Number of buckets
 
-    # Clearing memory
-    del [[current_period_nonus, current_period_us, prev_period_us, prev_period_nonus]]
-    gc.collect()
-    current_period_nonus, current_period_us = pd.DataFrame(), pd.DataFrame()
-    prev_period_us, prev_period_nonus = pd.DataFrame(), pd.DataFrame()
-    
-    logger.warning("Checkpoint 3")
-    logger.warning('Memory usage: %d (MB)' % (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024))
+    Returns:
+        An array of bucket indices
+    """
+    return pd.util.hash_array(np.asarray(mpids, dtype=np.int64)) % buckets
 
-    # Match to the link table
-    logger.warning("Preparing for unwinding")
-    current_period_mf_positions = current_period[current_period.cusip.isin(set(links.cusip))].merge(
-        links[['cusip', 'investing_mpid']], on=["cusip"], how="left").dropna(subset=['investing_mpid'])
 
-    # Unwind the positions: preparation
-    full_positions = pd.concat([current_period, prev_period], axis=0, sort=False).sort_values('date')
-    del [[current_period, prev_period]]
-    gc.collect()
-    current_period, prev_period = pd.DataFrame(), pd.DataFrame()
-    current_period_mf_positions.investing_mpid = current_period_mf_positions.investing_mpid.astype(int)
-    full_positions['investing_mpid'] = full_positions['MasterPortfolioId']
-    full_positions.investing_mpid = full_positions.investing_mpid.fillna(-1).astype(int)
-    current_period_mf_positions = current_period_mf_positions.sort_values('date')
-    full_positions['date_investing'] = full_positions['date']
+# Function to unwind holding funds' positions into the positions of the investing funds
+def unwind_positions(mf_positions, full_positions, logger, seq_cols=[]):
+    """ Runs the three unwinding merges (reporting dates, investing fund positions and investing fund
+    NAVs) and infers the size of the unwound positions. The merges only relate positions of the same
+    investing fund, so the function can be run on the complete period or on any subset of investing
+    funds (with the corresponding positions in both frames).
 
-    logger.warning("Checkpoint 4")
-    logger.warning('Memory usage: %d (MB)' % (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024))
+    Parameters:
+        mf_positions: Current positions of holding funds in investing funds, sorted by date
+        full_positions: Current and previous positions of all funds, sorted by date
+        logger: Logger object
+        seq_cols: Additional columns of mf_positions to be carried through the merges
 
+    Returns:
+        A dataframe with one row per unwound position
+    """
     # First asof merge to link to reporting dates
     logger.warning("Unwinding: Merge 1")
-    current_period_mf_positions['date'] = pd.to_datetime(current_period_mf_positions['date'])
     unwind_step1_links = pd.merge_asof(
-        current_period_mf_positions[
-            ['cusip', 'MasterPortfolioId', 'investing_mpid', 'date', 'marketvalue', 
-             'marketvalue_usd', 'currency_id', 'iso_country_code', '_obs_id', 'nonus']
-        ].sort_values('date').rename(
+        mf_positions[holding_cols + seq_cols].sort_values('date', kind='mergesort').rename(
             columns={'currency_id': 'holding_currency_id', 
                      'iso_country_code': 'holding_iso_country_code', 
                      '_obs_id': 'holding_obs_id',
                      'nonus': 'holding_nonus'}
         ),
-        full_positions[['investing_mpid', 'date', 'date_investing']].sort_values('date').dropna(subset=["date"]).drop_duplicates(), 
+        full_positions[['investing_mpid', 'date', 'date_investing']].sort_values('date', kind='mergesort').dropna(subset=["date"]).drop_duplicates(), 
         on=['date'], by=["investing_mpid"], 
         tolerance=pd.Timedelta(6, "M")).dropna(subset=["date_investing"])
 
@@ -189,20 +125,19 @@ if __name__ == "__main__":
         how="left", on=['investing_mpid', 'date_investing'], 
         suffixes=("", "_investing")).dropna(subset=['marketvalue_investing'])
     del unwind_step1_links; gc.collect()
-    unwind_step1_links = pd.DataFrame()
 
     logger.warning("Checkpoint 6")
     logger.warning('Memory usage: %d (MB)' % (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024))
 
     # Third merge to find funds' NAV
     logger.warning("Unwinding: Merge 3")
-    full_positions['marketvalue_usd_abs'] = np.abs(full_positions['marketvalue_usd'])
-    total_navs = pd.DataFrame(full_positions[full_positions.investing_mpid > -1].groupby(['investing_mpid', 'date'])['marketvalue_usd_abs'].sum()).reset_index()
-    full_positions = full_positions.drop(['marketvalue_usd_abs'], axis=1)
+    fund_positions = full_positions.loc[full_positions.investing_mpid > -1, ['investing_mpid', 'date', 'marketvalue_usd']].copy()
+    fund_positions['marketvalue_usd_abs'] = np.abs(fund_positions['marketvalue_usd'])
+    total_navs = pd.DataFrame(fund_positions.groupby(['investing_mpid', 'date'])['marketvalue_usd_abs'].sum()).reset_index()
+    del fund_positions
     total_navs = total_navs.rename(columns={'marketvalue_usd_abs': 'fund_nav_usd', 'date': 'date_investing'})
     unwind_step3_positions = unwind_step2_positions.merge(total_navs, on=['investing_mpid', 'date_investing'], how='left')
     del unwind_step2_positions; gc.collect()
-    unwind_step2_positions = pd.DataFrame()
 
     logger.warning("Checkpoint 7")
     logger.warning('Memory usage: %d (MB)' % (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024))
@@ -214,15 +149,260 @@ if __name__ == "__main__":
     unwind_step3_positions['inferred_position_usd'] = (unwind_step3_positions['marketvalue_usd_investing'] * unwind_step3_positions['holding_nav_percent'])
     unwind_step3_positions['inferred_position'] = (unwind_step3_positions['inferred_position_usd'] * unwind_step3_positions['lcu_per_usd_eop'])
 
-    # Save ancillary reports
-    unwind_step3_positions.to_pickle(
-        os.path.join(mns_data, "temp/mf_unwinding/mf_xb_reassignments", "mf_xbr_{}_{}{}.pkl".format(year, job_frequency, period))
-    )
-    logger.warning("Saving file {}".format(os.path.join(mns_data, "temp/mf_unwinding/mf_xb_reassignments", "mf_xbr_{}_{}{}.pkl".format(year, job_frequency, period))))
+    return unwind_step3_positions
+
+
+# Columns to be read in
+usecols = ['MasterPortfolioId', 'iso_currency_code', 'date', 'iso_country_code',
+    'cusip', 'currency_id', 'marketvalue', 'mns_class', '_obs_id', 'lcu_per_usd_eop']
+
+
+# Function to read in and deduplicate the link table
+def get_link_table(mns_data, stata_cache_dir, logger):
+    """ Reads in the Morningstar link table, dropping CUSIPs that are linked to more than one fund.
+
+    Parameters:
+        mns_data: MNS data path
+        stata_cache_dir: Stata cache folder (None to read directly)
+        logger: Logger object
+
+    Returns:
+        A dataframe with the deduplicated link table
+    """
+    logger.warning("Reading in the link table")
+    links = read_stata_cached(os.path.join(mns_data, 
+        "output/morningstar_api_data/Morningstar_API_Data_Link_Table.dta"), stata_cache_dir, logger=logger)
+    links['_count'] = 1
+    link_counts = pd.DataFrame(links.groupby('cusip')['_count'].sum())
+    links = links[~links.cusip.isin(set(link_counts[link_counts['_count'] > 1].index))]
+    del links['_count']
+    return links
+
+
+# Function to read in the positions of a given period
+def read_period(mns_data, year, period, job_frequency, stata_cache_dir, logger):
+    """ Reads in the NonUS and US step4 positions of a given period.
+
+    Parameters:
+        mns_data: MNS data path
+        year: Year of the period
+        period: Quarter or half-year of the period
+        job_frequency: q for quarterly; h for half-yearly
+        stata_cache_dir: Stata cache folder (None to read directly)
+        logger: Logger object
+
+    Returns:
+        A tuple with the NonUS and US positions
+    """
+    nonus = read_stata_cached(
+        os.path.join(mns_data, "temp/mf_unwinding/tmp_hd_files/NonUS_{}_{}{}_m_step4.dta".format(year, job_frequency, period)), stata_cache_dir, columns=usecols, logger=logger)
+    us = read_stata_cached(
+        os.path.join(mns_data, "temp/mf_unwinding/tmp_hd_files/US_{}_{}{}_m_step4.dta".format(year, job_frequency, period)), stata_cache_dir, columns=usecols, logger=logger)
+    return nonus, us
+
+
+# Function to store the positions of the primer period
+def write_primer_period(mns_data, year, period, job_frequency, period_nonus, period_us, logger):
+    """ Stores the positions of the primer period (the period preceding the first task) as step51
+    files; I verified there are no positions to be unwound in that period.
+    """
+    logger.warning("Processing primer period")
+    outcols = ["MasterPortfolioId", "_obs_id", "cusip", "date", "marketvalue", "mf_unwound"]
+    period_nonus.assign(mf_unwound=0)[outcols].to_stata(os.path.join(mns_data, "temp/mf_unwinding/hd_period_info/NonUS_{}_{}{}_m_step51.dta".format(year, job_frequency, period)), write_index=False)
+    period_us.assign(mf_unwound=0)[outcols].to_stata(os.path.join(mns_data, "temp/mf_unwinding/hd_period_info/US_{}_{}{}_m_step51.dta".format(year, job_frequency, period)), write_index=False)
+
+
+# Function to prepare the positions of a period for unwinding
+def prepare_positions(current_frames, prev_frames, links, logger):
+    """ Combines the NonUS and US positions of the current and previous periods and matches the
+    current positions to the link table. The input frames are not modified.
+
+    Parameters:
+        current_frames: Tuple with the NonUS and US positions of the period
+        prev_frames: Tuple with the NonUS and US positions of the preceding period
+        links: Deduplicated link table
+        logger: Logger object
+
+    Returns:
+        A tuple with the current positions of holding funds in investing funds (sorted by date)
+        and the current and previous positions of all funds (sorted by date)
+    """
+    current_period_nonus, current_period_us = current_frames
+    prev_period_nonus, prev_period_us = prev_frames
+
+    logger.warning("Checkpoint 1")
+    logger.warning('Memory usage: %d (MB)' % (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024))
+
+    # Concatenate
+    current_period = pd.concat([current_period_nonus.assign(nonus=1), current_period_us.assign(nonus=0)], axis=0, sort=False)
+    prev_period = pd.concat([prev_period_nonus.assign(nonus=1), prev_period_us.assign(nonus=0)], axis=0, sort=False)
+    current_period['current'] = 1
+    prev_period['current'] = 0
+
+    # Perform currency conversion
+    current_period['marketvalue_usd'] = current_period['marketvalue'] / current_period['lcu_per_usd_eop']
+    prev_period['marketvalue_usd'] = prev_period['marketvalue'] / prev_period['lcu_per_usd_eop']
+
+    # Match to the link table
+    logger.warning("Preparing for unwinding")
+    current_period_mf_positions = current_period[current_period.cusip.isin(set(links.cusip))].merge(
+        links[['cusip', 'investing_mpid']], on=["cusip"], how="left").dropna(subset=['investing_mpid'])
+
+    # Unwind the positions: preparation
+    full_positions = pd.concat([current_period, prev_period], axis=0, sort=False).sort_values('date')
+    del [[current_period, prev_period]]
+    gc.collect()
+    current_period, prev_period = pd.DataFrame(), pd.DataFrame()
+    current_period_mf_positions.investing_mpid = current_period_mf_positions.investing_mpid.astype(int)
+    full_positions['investing_mpid'] = full_positions['MasterPortfolioId']
+    full_positions.investing_mpid = full_positions.investing_mpid.fillna(-1).astype(int)
+    current_period_mf_positions = current_period_mf_positions.sort_values('date')
+    full_positions['date_investing'] = full_positions['date']
+    current_period_mf_positions['date'] = pd.to_datetime(current_period_mf_positions['date'])
+
+    logger.warning("Checkpoint 4")
+    logger.warning('Memory usage: %d (MB)' % (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024))
+
+    return current_period_mf_positions, full_positions
+
+
+# Function to extract the new positions and rescaling inputs from unwound positions
+def get_unwound_outputs(unwound_positions, extra_cols=[]):
+    """ Extracts the fields of the unwound positions needed for the outfiles and for rescaling, so
+    that the (wide) unwound positions can be released.
+
+    Parameters:
+        unwound_positions: Unwound positions, as returned by unwind_positions
+        extra_cols: Additional columns to be kept with the new positions
+
+    Returns:
+        A tuple with the IDs of the unwound holding fund positions, the new positions to be included
+        in the dataset, and the NAV shares held in each investing fund position (by _obs_id)
+    """
+    unwound_idx = unwound_positions['holding_obs_id'].values
+    new_positions = unwound_positions[['MasterPortfolioId', 'cusip_investing', 'inferred_position', '_obs_id',
+        'date', 'current', 'holding_nonus'] + extra_cols].rename(columns={'cusip_investing': 'cusip', 'inferred_position': 'marketvalue'})
+    new_positions['mf_unwound'] = 1
+    nav_shares = pd.DataFrame(unwound_positions.groupby('_obs_id')['holding_nav_percent'].sum()).reset_index()
+    return unwound_idx, new_positions, nav_shares
+
+
+# Function to read and combine the bucket files of a streamed unwinding run
+def read_bucket_files(paths):
+    """ Reads the bucket files written by unwind_period and restores the single-pass row order.
+    """
+    parts = [pd.read_pickle(path) for path in paths]
+    parts = [x for x in parts if x.shape[0] > 0] or parts[:1]
+    df = pd.concat(parts, axis=0, sort=False)
+    del parts; gc.collect()
+    order = np.lexsort([df[col].values for col in reversed(bucket_seq_cols)])
+    df = df.drop(bucket_seq_cols, axis=1)
+    return df.take(order).reset_index(drop=True)
+
+
+# Function to read in the xbr report of a period
+def read_xbr_report(mns_data, year, job_frequency, period):
+    """ Reads in the ancillary (xbr) report of the unwound positions of a given period, written
+    either as a single pickle (single-pass run) or as one pickle per investing fund bucket
+    (streamed run). In both cases, the rows are returned in single-pass order.
+
+    Parameters:
+        mns_data: MNS data path
+        year: Year of the period
+        job_frequency: q for quarterly; h for half-yearly
+        period: Quarter or half-year of the period
+
+    Returns:
+        A dataframe with one row per unwound position
+    """
+    xbr_path = os.path.join(mns_data, "temp/mf_unwinding/mf_xb_reassignments", "mf_xbr_{}_{}{}.pkl".format(year, job_frequency, period))
+    if os.path.exists(xbr_path):
+        return pd.read_pickle(xbr_path)
+    bucket_paths = sorted(glob.glob(xbr_path[:-len(".pkl")] + "_bucket*.pkl"))
+    if len(bucket_paths) == 0:
+        raise Exception("No xbr report found for year {}, {} = {}".format(year, job_frequency, period))
+    return read_bucket_files(bucket_paths)
+
+
+# Function to unwind the positions of a single period
+def unwind_period(mns_data, year, period, job_frequency, current_frames, prev_frames, links, buckets, logger):
+    """ Unwinds the fund-in-fund positions of a given period, and stores the step51 positions, the
+    rescaling list and the ancillary (xbr) reports. The input frames are not modified, so that they
+    can be reused for the following period.
+
+    Parameters:
+        mns_data: MNS data path
+        year: Year of the period
+        period: Quarter or half-year of the period
+        job_frequency: q for quarterly; h for half-yearly
+        current_frames: Tuple with the NonUS and US positions of the period
+        prev_frames: Tuple with the NonUS and US positions of the preceding period
+        links: Deduplicated link table
+        buckets: Number of investing fund hash buckets (1 for a single pass)
+        logger: Logger object
+    """
+    current_period_mf_positions, full_positions = prepare_positions(current_frames, prev_frames, links, logger)
+
+    # Remove xbr reports and bucket files of earlier runs
+    xbr_path = os.path.join(mns_data, "temp/mf_unwinding/mf_xb_reassignments", "mf_xbr_{}_{}{}.pkl".format(year, job_frequency, period))
+    xbr_bucket_paths = [xbr_path[:-len(".pkl")] + "_bucket{}.pkl".format(x) for x in range(buckets)]
+    new_positions_bucket_paths = [xbr_path[:-len(".pkl")] + "_new_positions_bucket{}.pkl".format(x) for x in range(buckets)]
+    for fname in glob.glob(xbr_path[:-len(".pkl")] + "_*bucket*.pkl") + [xbr_path]:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+    # Run the unwinding merges
+    with stage_timer("unwinding_merges", logger, rows=current_period_mf_positions.shape[0], level=logging.WARNING,
+            year=year, period=period, buckets=buckets):
+
+        # Unwind all positions in a single pass
+        if buckets == 1:
+            unwind_step3_positions = unwind_positions(current_period_mf_positions, full_positions, logger)
+
+            # Save ancillary reports
+            unwind_step3_positions.to_pickle(xbr_path)
+            logger.warning("Saving file {}".format(xbr_path))
+
+            # Only keep the fields required for rescaling and the outfiles
+            unwound_idx, unwind_step4_positions, mf_rescaling_list = get_unwound_outputs(unwind_step3_positions)
+            del unwind_step3_positions; gc.collect()
+
+        # Else stream the investing funds through the merges bucket by bucket
+        else:
+            logger.warning("Unwinding in {} investing fund buckets".format(buckets))
+
+            # Sequence numbers restore the single-pass row order of the unwound positions
+            current_period_mf_positions['_holding_seq'] = np.arange(current_period_mf_positions.shape[0])
+            full_positions['_investing_seq'] = np.arange(full_positions.shape[0])
+            mf_buckets = get_buckets(current_period_mf_positions['investing_mpid'].values, buckets)
+            full_buckets = get_buckets(full_positions['investing_mpid'].values, buckets)
+
+            unwound_idx_parts, nav_share_parts = [], []
+            for bucket in range(buckets):
+                logger.warning("Unwinding: bucket {} of {}".format(bucket + 1, buckets))
+                bucket_positions = unwind_positions(current_period_mf_positions[mf_buckets == bucket],
+                    full_positions[full_buckets == bucket], logger, seq_cols=['_holding_seq'])
+
+                # Save ancillary reports and spool the new positions of the bucket to disk
+                bucket_positions.to_pickle(xbr_bucket_paths[bucket])
+                logger.warning("Saving file {}".format(xbr_bucket_paths[bucket]))
+                bucket_idx, bucket_new_positions, bucket_nav_shares = get_unwound_outputs(bucket_positions, bucket_seq_cols)
+                bucket_new_positions.to_pickle(new_positions_bucket_paths[bucket])
+                unwound_idx_parts.append(bucket_idx)
+                nav_share_parts.append(bucket_nav_shares)
+                logger.warning("Bucket {}: {} unwound positions".format(bucket + 1, bucket_positions.shape[0]))
+                del bucket_positions, bucket_new_positions; gc.collect()
+                logger.warning('Memory usage: %d (MB)' % (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024))
+
+            # Investing fund positions never span buckets, so the NAV shares only need to be combined
+            unwound_idx = np.concatenate(unwound_idx_parts)
+            mf_rescaling_list = pd.DataFrame(pd.concat(nav_share_parts, axis=0, sort=False).groupby('_obs_id')['holding_nav_percent'].sum()).reset_index()
+            del unwound_idx_parts, nav_share_parts, current_period_mf_positions, mf_buckets, full_buckets
+            full_positions = full_positions.drop(['_investing_seq'], axis=1)
+            gc.collect()
 
     # Positions to be deleted from dataset (unwound)
     logger.warning("Unwinding: Merge 4")
-    unwound_idx = unwind_step3_positions['holding_obs_id'].values
 
     # Standardize fields
     full_positions['date'] = pd.to_datetime(full_positions['date'])
@@ -245,13 +425,6 @@ if __name__ == "__main__":
         os.path.join(mns_data, "temp/mf_unwinding/mf_xb_reassignments", "mf_xbr_{}_{}{}_non_mf.dta".format(year, job_frequency, period)), write_index=False
     )
 
-    # Prepare new positions for inclusion in the dataset
-    unwind_step4_positions = unwind_step3_positions.copy()
-    unwind_step4_positions['cusip'] = unwind_step4_positions['cusip_investing']
-    unwind_step4_positions['marketvalue'] = unwind_step4_positions['inferred_position']
-    unwind_step4_positions = unwind_step4_positions[['MasterPortfolioId', 'cusip', 'marketvalue', '_obs_id', 'date', 'current', 'holding_nonus']]
-    unwind_step4_positions['mf_unwound'] = 1
-
     logger.warning("Checkpoint 8")
     logger.warning('Memory usage: %d (MB)' % (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024))
 
@@ -259,7 +432,6 @@ if __name__ == "__main__":
     # As noted above, sometimes the reported position of the holding fund is greater than the total market value 
     # of all the positions held by the investing fund. In these cases I impose a floor of 0 on the rescaling factor.
     logger.warning("Unwinding: Rescaling")
-    mf_rescaling_list = pd.DataFrame(unwind_step3_positions.groupby('_obs_id')['holding_nav_percent'].sum()).reset_index()
     mf_rescaling_list['mf_scaling_factor'] = np.maximum(1 - mf_rescaling_list['holding_nav_percent'], 0.)
     mf_rescaling_list['mf_rescaled'] = 1
     mf_rescaling_list = mf_rescaling_list.drop('holding_nav_percent', axis=1)
@@ -277,14 +449,21 @@ if __name__ == "__main__":
         logger.warning(mf_rescaling_list.to_string())
     mf_rescaling_list.to_stata(os.path.join(mns_data, "temp/mf_unwinding/mf_scaling_lists", "mf_scalings_{}_{}{}.dta".format(year, job_frequency, period)), write_index=False)
 
-    # Finalize the outfile
+    # Finalize the outfile; the period's positions are released before the new positions are read back in
     logger.warning("Unwinding: Finalizing outfiles")
+    current_period_out = full_positions[(full_positions.current == 1) & ~(full_positions._obs_id.isin(unwound_idx))][
+        ['MasterPortfolioId', 'cusip', 'marketvalue', '_obs_id', 'date', 'current', 'nonus']
+    ]
+    del full_positions, unwound_idx; gc.collect()
+    if buckets > 1:
+        unwind_step4_positions = read_bucket_files(new_positions_bucket_paths)
+        for fname in new_positions_bucket_paths:
+            os.remove(fname)
     current_period_out = pd.concat([
-        full_positions[(full_positions.current == 1) & ~(full_positions._obs_id.isin(unwound_idx))][
-            ['MasterPortfolioId', 'cusip', 'marketvalue', '_obs_id', 'date', 'current', 'nonus']
-        ],
+        current_period_out,
         unwind_step4_positions.rename(columns={'holding_nonus': 'nonus'})
     ], sort=False).drop(['current'], axis=1).sort_values('date', ascending=True)
+    del unwind_step4_positions; gc.collect()
     current_period_out['mf_unwound'] = current_period_out['mf_unwound'].fillna(0).astype(bool)
     initial_col_set = set(current_period_out.columns)
 
@@ -304,6 +483,128 @@ if __name__ == "__main__":
     logger.warning("Checkpoint 10")
     logger.warning('Memory usage: %d (MB)' % (int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024))
 
+
+# Function to unwind a contiguous range of tasks
+def unwind_tasks(tasks, mns_data, firstyear, job_frequency, links, buckets, stata_cache_dir):
+    """ Unwinds the periods of a contiguous range of tasks in a single process. The positions of
+    each period are kept in memory for the following task, so that every step4 file is only read
+    once (rather than once as the current and once as the previous period).
+
+    Parameters:
+        tasks: List of consecutive task IDs
+        mns_data: MNS data path
+        firstyear: First year in dataset
+        job_frequency: q for quarterly; h for half-yearly
+        links: Deduplicated link table
+        buckets: Number of investing fund hash buckets (1 for a single pass)
+        stata_cache_dir: Stata cache folder (None to read directly)
+
+    Returns:
+        A list of (taskid, year, period, seconds) tuples
+    """
+    logger = logging.getLogger(__name__)
+    timings = []
+    window_period, window_frames = None, None
+    for taskid in tasks:
+
+        # Get chronological markers
+        year, period, prev_year, prev_period = get_chron_markers(taskid, firstyear, job_frequency)
+
+        # Report period
+        logger.warning("Running MF positions unwinding for year {}, {} = {}".format(year, job_frequency, period))
+
+        with stage_timer("unwind_period", logger, level=logging.WARNING, year=year, period=period) as stage:
+
+            # Load in the files, reusing the previous task's current period where possible
+            if window_period == (prev_year, prev_period):
+                prev_frames = window_frames
+            else:
+                prev_frames = read_period(mns_data, prev_year, prev_period, job_frequency, stata_cache_dir, logger)
+            current_frames = read_period(mns_data, year, period, job_frequency, stata_cache_dir, logger)
+            window_period, window_frames = (year, period), current_frames
+            stage['rows'] = sum(frame.shape[0] for frame in current_frames)
+
+            # Take special care of the first period
+            if taskid == 1:
+                write_primer_period(mns_data, prev_year, prev_period, job_frequency, prev_frames[0], prev_frames[1], logger)
+
+            unwind_period(mns_data, year, period, job_frequency, current_frames, prev_frames, links, buckets, logger)
+            del prev_frames; gc.collect()
+
+        logger.warning("Finished year {}, {} = {} in {:.1f}s".format(year, job_frequency, period, stage['wall_seconds']))
+        timings.append((taskid, year, period, stage['wall_seconds']))
+
+    log_cache_summary(logger)
+    return timings
+
+
+# Pool wrapper for unwind_tasks
+def unwind_tasks_star(args):
+    return unwind_tasks(*args)
+
+
+# Main routine
+if __name__ == "__main__":
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--taskid", type=int, help="Year for processing (as SLURM task ID); first task if --lasttask is set")
+    parser.add_argument("-l", "--lasttask", type=int, default=None, help="Last task to process in this run (defaults to --taskid)")
+    parser.add_argument("-d", "--datapath", type=str, help="MNS data path")
+    parser.add_argument("-f", "--firstyear", type=int, help="First year in dataset")
+    parser.add_argument("-j", "--jobfrequency", type=str, default="h", choices=["q", "h"], help="Period length: q for quarterly; h for half-yearly")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes for multi-task runs")
+    parser.add_argument("-b", "--buckets", type=int, default=1, help="Number of investing fund hash buckets for streamed unwinding (1 for a single pass)")
+    parser.add_argument("-s", "--statacache", type=int, default=1, help="Whether to cache Stata inputs in columnar format (boolean flag)")
+    args = parser.parse_args()
+    mns_data = args.datapath
+    stata_cache_dir = os.path.join(mns_data, "temp/stata_cache") if args.statacache else None
+    firstyear = args.firstyear
+    taskid = args.taskid
+    lasttask = taskid if args.lasttask is None else args.lasttask
+    tasks = list(range(taskid, lasttask + 1))
+    workers = max(min(args.workers, len(tasks)), 1)
+    buckets = max(args.buckets, 1)
+    job_frequency = args.jobfrequency
+    
+    # Set up logging
+    logger = logging.getLogger(__name__)
+    tasklabel = taskid if lasttask == taskid else "{}-{}".format(taskid, lasttask)
+    logfile = '{}/results/logs/{}_Unwind_MF_Positions_Step1_{}.log'.format(mns_data, getpass.getuser(), tasklabel)
+    if os.path.exists(logfile):
+        os.remove(logfile)
+    logging.basicConfig(filename=logfile, filemode='w', level=logging.DEBUG)
+    sys.stderr = open(logfile, 'a')
+    sys.stdout = open(logfile, 'a')
+    logging.info("Begin Unwinding_MF_Positions")
+
+    # Ensure relevant directories exist
+    distutils.dir_util.mkpath(os.path.join(mns_data, "temp/mf_unwinding/mf_xb_reassignments"))
+    distutils.dir_util.mkpath(os.path.join(mns_data, "temp/mf_unwinding/mf_scaling_lists"))
+    distutils.dir_util.mkpath(os.path.join(mns_data, "temp/mf_unwinding/hd_period_info"))
+
+    # Read in link table (once for all tasks)
+    links = get_link_table(mns_data, stata_cache_dir, logger)
+
+    # Process the tasks, either in this process or split into contiguous blocks across workers
+    run_start = time.time()
+    if workers == 1:
+        timings = unwind_tasks(tasks, mns_data, firstyear, job_frequency, links, buckets, stata_cache_dir)
+    else:
+        logger.warning("Starting multiprocessing pool with {} workers".format(workers))
+        blocks = [[int(t) for t in block] for block in np.array_split(tasks, workers)]
+        pool = Pool(workers)
+        block_timings = pool.map(unwind_tasks_star, 
+            [(block, mns_data, firstyear, job_frequency, links, buckets, stata_cache_dir) for block in blocks])
+        pool.close()
+        pool.join()
+        timings = list(chain.from_iterable(block_timings))
+
+    # Report timing
+    for task, year, period, elapsed in timings:
+        logger.warning("Task {} (year {}, {} = {}): {:.1f}s".format(task, year, job_frequency, period, elapsed))
+    logger.warning("Unwound {} periods in {:.1f}s".format(len(timings), time.time() - run_start))
+
     # Close logs
     sys.stderr.close()
     sys.stdout.close()
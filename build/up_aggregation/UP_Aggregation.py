@@ -42,6 +42,10 @@ tqdm.pandas()
 
 from Project_Constants import tax_havens, source_preference_order
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from stata_cache import read_stata_cached, log_cache_summary
+from stage_timer import stage_timer
+
 
 # Main decision function for UP aggregation
 def determine_ultimate_parent_and_country_assignment(row, source_preference_order, country_details_master):
@@ -488,22 +492,9 @@ def determine_ultimate_parent_and_country_assignment(row, source_preference_orde
     if return_tuple[1] == "" and return_tuple[2] > -1:
 
         issuer_num = return_tuple[0] 
-        source_preference_order_inv = {v:k for k,v in source_preference_order.items()}
         country_fallback, fallback_code = get_country_fallback_for_cusip(issuer_num, 
                 source_preference_order, country_details_master)
-        extra_messages = {
-            'A': "blank country replaced with {}".format(source_preference_order_inv[1]),
-            'B': "blank country replaced with {}".format(source_preference_order_inv[2]),
-            'C': "blank country replaced with {}".format(source_preference_order_inv[3]),
-            'D': "blank country replaced with {}".format(source_preference_order_inv[4]),
-            'E': "blank country replaced with {}".format(source_preference_order_inv[5]),
-            'F': "blank country replaced with country_ai",
-            'G': "blank country replaced with country_ms_ai",
-            'H': "blank country replaced with cgs_domicile",
-            'I': "blank country replaced with country_ms",
-            'J': "blank country replaced with cgs_domicile",
-            'K': "no non-blank country code present"
-        }
+        extra_messages = get_country_fallback_messages(source_preference_order)
 
         return_tuple = (
             return_tuple[0], 
@@ -578,6 +569,317 @@ def get_country_fallback_for_cusip(issuer_num_up, source_preference_order, count
         return ("", "K")
 
 
+# Messages describing which field was used to fill in a blank country code
+def get_country_fallback_messages(source_preference_order):
+    source_preference_order_inv = {v:k for k,v in source_preference_order.items()}
+    return {
+        'A': "blank country replaced with {}".format(source_preference_order_inv[1]),
+        'B': "blank country replaced with {}".format(source_preference_order_inv[2]),
+        'C': "blank country replaced with {}".format(source_preference_order_inv[3]),
+        'D': "blank country replaced with {}".format(source_preference_order_inv[4]),
+        'E': "blank country replaced with {}".format(source_preference_order_inv[5]),
+        'F': "blank country replaced with country_ai",
+        'G': "blank country replaced with country_ms_ai",
+        'H': "blank country replaced with cgs_domicile",
+        'I': "blank country replaced with country_ms",
+        'J': "blank country replaced with cgs_domicile",
+        'K': "no non-blank country code present"
+    }
+
+
+# Sources entering the aggregation rules, in the order used by the decision function
+up_sources = ["ciq", "sdc", "bvd", "dlg", "fds"]
+
+# Output columns of the aggregation, in the order of the decision function's return tuple
+assignment_columns = ['cusip6_up_bg', 'country_bg', 'aggregation_case_code', 'cusip6_up_bg_source',
+                      'country_bg_source', 'aggregation_additional_info']
+
+# Two-majority case codes; the row-wise rules order the two majorities by set iteration order
+two_majority_case_codes = [47, 48, 49, 50, 56, 57, 147, 148, 149, 150, 156, 157]
+
+
+# Columnar version of get_country_fallback_for_cusip, evaluated once per CUSIP6
+def get_country_fallback_table(country_details_frame, source_preference_order):
+    """
+    This function computes the best country guess for every CUSIP6 in the country details table.
+
+    Parameters:
+        country_details_frame: A dataframe indexed by CUSIP6 listing each source's country assignment
+        source_preference_order: Arbitrary source preference ordering (dictionary)
+
+    Returns:
+        A dataframe indexed by CUSIP6 with columns country_fallback and fallback_code
+    """
+
+    # Note that the row-wise function checks the fourth preferred source twice (codes D and E); we mirror this
+    source_preference_order_inv = {v:k for k,v in source_preference_order.items()}
+    fallback_cols = ['country_{}'.format(source_preference_order_inv[i]) for i in [1, 2, 3, 4, 4]] + \
+        ['country_ai', 'country_ms_ai', 'cgs_domicile', 'country_ms']
+    conditions = [((country_details_frame[col] != "") & ~country_details_frame[col].isin(tax_havens)).values
+        for col in fallback_cols] + [(country_details_frame['cgs_domicile'] != "").values]
+    choices = [country_details_frame[col].values for col in fallback_cols] + [country_details_frame['cgs_domicile'].values]
+
+    return pd.DataFrame({
+        'country_fallback': np.select(conditions, choices, default="").astype(object),
+        'fallback_code': np.select(conditions, list("ABCDEFGHIJ"), default="K").astype(object)
+    }, index=country_details_frame.index)
+
+
+# Look up precomputed country fallbacks for an array of CUSIP6 codes
+def lookup_country_fallback(fallback_table, cusips):
+    ix = fallback_table.index.get_indexer(cusips)
+    found = ix > -1
+    country_fallback = np.where(found, fallback_table['country_fallback'].values[ix], "").astype(object)
+    fallback_code = np.where(found, fallback_table['fallback_code'].values[ix], "L").astype(object)
+    return country_fallback, fallback_code
+
+
+# Columnar version of determine_ultimate_parent_and_country_assignment
+def determine_ultimate_parent_and_country_assignment_vectorized(df, source_preference_order, country_details_frame):
+    """
+    This function performs UP and country aggregation for all rows at once, applying the same decision
+    rules as determine_ultimate_parent_and_country_assignment via boolean masks and np.select.
+
+    Parameters:
+        df: The input dataframe
+        source_preference_order: Arbitrary source preference ordering (dictionary)
+        country_details_frame: A dataframe indexed by CUSIP6 listing each source's country assignment
+
+    Returns:
+        A dataframe with the columns in assignment_columns, indexed like df. Where two pairs of sources
+        agree on different codes, the two majorities are ordered by their first source in up_sources.
+    """
+
+    # Some common objects
+    n_rows = df.shape[0]
+    rows = np.arange(n_rows)
+    cols = np.arange(len(up_sources))
+    sources = np.array(up_sources, dtype=object)
+    prefs = np.array([source_preference_order[s] for s in up_sources])
+    worst_pref = prefs.max() + 1
+    source_labels = np.array([" ".join(s for (i, s) in enumerate(up_sources) if mask & (1 << i))
+        for mask in range(1 << len(up_sources))], dtype=object)
+
+    def _is_fp(values):
+        return pd.Series(values.ravel()).isin(tax_havens).values.reshape(values.shape)
+
+    def _pick(values, ix):
+        return values[rows, ix]
+
+    def _first(mask):
+        return np.argmax(mask, axis=1)
+
+    def _next(mask, after):
+        return np.argmax(mask & (cols[None, :] > after[:, None]), axis=1)
+
+    def _label(mask):
+        return source_labels[(mask * (1 << cols)[None, :]).sum(axis=1)]
+
+    # Source UP codes and countries (rows x sources)
+    up_cusip6 = df[['cusip6_up_{}'.format(s) for s in up_sources]].values
+    up_country = df[['country_{}'.format(s) for s in up_sources]].values
+    present = up_cusip6 != ""
+    country_present = up_country != ""
+    country_fp = _is_fp(up_country)
+
+    # Agreement structure among the sources
+    cusip_codes, cusip_uniques = pd.factorize(up_cusip6.ravel())
+    cusip_codes = cusip_codes.reshape(up_cusip6.shape)
+    agree_count = (cusip_codes[:, :, None] == cusip_codes[:, None, :]).sum(axis=2) * present
+    n_present = present.sum(axis=1)
+    n_agree_pairs = (agree_count - present).sum(axis=1) // 2
+    max_agree = agree_count.max(axis=1)
+
+    # Country fallbacks, computed once per CUSIP6
+    fallback_table = get_country_fallback_table(country_details_frame, source_preference_order)
+    unique_fallback_country, _ = lookup_country_fallback(fallback_table, np.asarray(cusip_uniques, dtype=object))
+    fallback_nfp = ~_is_fp(unique_fallback_country)[cusip_codes]
+
+    # AI, MS and CGS fields
+    issuer_number = df['issuer_number'].values
+    cusip6_up_ai = df['cusip6_up_ai'].values
+    country_ai = df['country_ai'].values
+    country_ms_ai = df['country_ms_ai'].values
+    cgs_domicile = df['cgs_domicile'].values
+    country_ms = df['country_ms'].values
+    ai_present = (cusip6_up_ai != "") & (country_ai != "")
+    ai_nfp = ai_present & ~_is_fp(country_ai)
+    ai_ms_nfp = ai_present & _is_fp(country_ai) & (country_ms_ai != "") & ~_is_fp(country_ms_ai)
+    cgs_nfp = (cgs_domicile != "") & ~_is_fp(cgs_domicile)
+    cgs_ms_nfp = (cgs_domicile != "") & _is_fp(cgs_domicile) & (country_ms != "") & ~_is_fp(country_ms)
+
+    # Rules are tuples (condition, case_code, up_cusip6_bg, country_bg, up_cusip6_bg_source, country_bg_source)
+    def _source_rule(condition, case_code, ix, label=None):
+        source = sources[ix] if label is None else label
+        return (condition, case_code, _pick(up_cusip6, ix), _pick(up_country, ix), source, source)
+
+    def _outside_rules(group, first_code):
+        return [
+            (group & ai_nfp, first_code, cusip6_up_ai, country_ai, "cusip6_up_ai", "country_ai"),
+            (group & ai_ms_nfp, first_code + 1, cusip6_up_ai, country_ms_ai, "cusip6_up_ai", "country_ms_ai"),
+            (group & cgs_nfp, first_code + 2, issuer_number, cgs_domicile, "immediate_issuer_number", "cgs_domicile"),
+            (group & cgs_ms_nfp, first_code + 3, issuer_number, country_ms, "immediate_issuer_number", "country_ms")
+        ]
+
+    # Case groups, mutually exclusive and in the order of the row-wise decision function
+    all_agree = (n_present == 5) & (max_agree == 5)
+    only_one = ~all_agree & (n_present == 1)
+    none_present = ~all_agree & (n_present == 0)
+    all_disagree = ~all_agree & (n_present >= 2) & (n_agree_pairs == 0)
+    remaining = ~all_agree & ~only_one & ~none_present & ~all_disagree
+    majority = remaining & (n_present >= 3) & (max_agree >= 3)
+    one_pair = remaining & ~majority & (n_present >= 2) & (n_agree_pairs == 1)
+    two_pairs = remaining & ~majority & ~one_pair & (n_present >= 4) & (n_agree_pairs == 2)
+
+    # CIQ, SDC, BVD, DLG, FDS all present and agree
+    zeros = np.zeros(n_rows, dtype=int)
+    rules = [_source_rule(all_agree & country_present[:, 0] & ~country_fp[:, 0] & fallback_nfp[:, 0], 1, zeros,
+        source_labels[-1])]
+    rules += _outside_rules(all_agree, 2)
+    rules += [_source_rule(all_agree, 6, zeros, source_labels[-1])]
+
+    # Only one of CIQ, SDC, BVD, DLG, FDS is present
+    single_ix = _first(present)
+    rules += [_source_rule(only_one & ~_pick(country_fp, single_ix) & _pick(fallback_nfp, single_ix), 7, single_ix)]
+    rules += _outside_rules(only_one, 8)
+    rules += [_source_rule(only_one, 12, single_ix)]
+
+    # None of CIQ, SDC, BVD, DLG, FDS are present
+    rules += _outside_rules(none_present, 13)
+    rules += [
+        (none_present & (cusip6_up_ai != ""), 17, cusip6_up_ai, country_ai, "cusip6_up_ai", "country_ai"),
+        (none_present, 18, issuer_number, cgs_domicile, "immediate_issuer_number", "cgs_domicile")
+    ]
+
+    # 2 to 5 of CIQ, SDC, BVD, DLG, FDS are present and all disagree
+    nonblank_nfp = present & ~country_fp
+    nfp_count = np.where(nonblank_nfp.any(axis=1), (country_present & ~country_fp & fallback_nfp).sum(axis=1), 0)
+    first_ix = _first(present)
+    second_ix = _next(present, first_ix)
+    rules += [_source_rule(all_disagree & (nfp_count == 1), 19, _first(nonblank_nfp))]
+    rules += _outside_rules(all_disagree & (nfp_count == 0), 20)
+    rules += [
+        _source_rule(all_disagree & (nfp_count == 0), 24,
+            np.where(prefs[first_ix] < prefs[second_ix], first_ix, second_ix)),
+        _source_rule(all_disagree & (nfp_count > 1), 25, np.argmin(np.where(nonblank_nfp, prefs, worst_pref), axis=1))
+    ]
+
+    # Three or more agree (codes 26-34), or exactly two agree (codes 35-46)
+    agreed = present & (agree_count == max_agree[:, None])
+    agreed_ix = _first(agreed)
+    agreed_label = _label(agreed)
+    agreed_nfp = ~_pick(country_fp, agreed_ix) & _pick(fallback_nfp, agreed_ix)
+    outlier_nfp = ~agreed & present & country_present & ~country_fp
+    n_outlier_nfp = outlier_nfp.sum(axis=1)
+    outlier_x = _first(outlier_nfp)
+    outlier_y = _next(outlier_nfp, outlier_x)
+    outlier_z = _next(outlier_nfp, outlier_y)
+    min_outlier_pref = np.minimum(np.minimum(prefs[outlier_x], prefs[outlier_y]), prefs[outlier_z])
+    for (group, first_code, three_outlier_rules) in [(majority, 26, False), (one_pair, 35, True)]:
+        rules += [
+            _source_rule(group & agreed_nfp, first_code, agreed_ix, agreed_label),
+            _source_rule(group & (n_outlier_nfp == 1), first_code + 1, outlier_x),
+            _source_rule(group & (n_outlier_nfp == 2) & (prefs[outlier_x] < prefs[outlier_y]), first_code + 2, outlier_x),
+            _source_rule(group & (n_outlier_nfp == 2), first_code + 3, outlier_y)
+        ]
+        if three_outlier_rules:
+            rules += [
+                _source_rule(group & (n_outlier_nfp == 3) & (prefs[outlier_x] == min_outlier_pref), first_code + 4, outlier_x),
+                _source_rule(group & (n_outlier_nfp == 3) & (prefs[outlier_y] == min_outlier_pref), first_code + 5, outlier_y),
+                _source_rule(group & (n_outlier_nfp == 3), first_code + 6, outlier_z)
+            ]
+        outside_code = first_code + (7 if three_outlier_rules else 4)
+        rules += _outside_rules(group, outside_code)
+        rules += [_source_rule(group, outside_code + 4, agreed_ix, agreed_label)]
+
+    # Four or five are present and there are two majorities
+    paired = present & (agree_count == 2)
+    pair_x = _first(paired)
+    members_x = present & (cusip_codes == _pick(cusip_codes, pair_x)[:, None])
+    pair_y = _first(paired & ~members_x)
+    members_y = present & (cusip_codes == _pick(cusip_codes, pair_y)[:, None])
+    pair_outlier = _first(~(members_x | members_y))
+    pair_x_nfp_country = _pick(country_present & ~country_fp, pair_x)
+    pair_y_nfp_country = _pick(country_present & ~country_fp, pair_y)
+    n_nfp_pairs = (pair_x_nfp_country & _pick(fallback_nfp, pair_x)).astype(int) + \
+        (pair_y_nfp_country & _pick(fallback_nfp, pair_y)).astype(int)
+    pair_x_preferred = np.where(members_x, prefs, worst_pref).min(axis=1) == 1
+    if (two_pairs & (n_nfp_pairs == 1) & ~pair_x_nfp_country & ~pair_y_nfp_country).any():
+        raise Exception("Something went wrong in UP aggregation; stack checkpoint 2")
+    rules += [
+        _source_rule(two_pairs & (n_nfp_pairs == 1) & pair_x_nfp_country, 47, pair_x, _label(members_x)),
+        _source_rule(two_pairs & (n_nfp_pairs == 1) & pair_y_nfp_country, 48, pair_y, _label(members_y)),
+        _source_rule(two_pairs & (n_nfp_pairs == 2) & pair_x_preferred, 49, pair_x, _label(members_x)),
+        _source_rule(two_pairs & (n_nfp_pairs == 2), 50, pair_y, _label(members_y)),
+        _source_rule(two_pairs & _pick(present & country_present & ~country_fp, pair_outlier), 51, pair_outlier)
+    ]
+    rules += _outside_rules(two_pairs, 52)
+    rules += [
+        _source_rule(two_pairs & pair_x_preferred, 56, pair_x, _label(members_x)),
+        _source_rule(two_pairs, 57, pair_y, _label(members_y))
+    ]
+
+    # Evaluate the rules; rows matching none of them get case code -1
+    conditions = [rule[0] for rule in rules]
+    up_cusip6_bg = np.select(conditions, [rule[2] for rule in rules], default="").astype(object)
+    country_bg = np.select(conditions, [rule[3] for rule in rules], default="").astype(object)
+    case_code = np.select(conditions, [rule[1] for rule in rules], default=-1)
+    up_cusip6_bg_source = np.select(conditions, [rule[4] for rule in rules], default="").astype(object)
+    country_bg_source = np.select(conditions, [rule[5] for rule in rules], default="").astype(object)
+    extra_info = np.full(n_rows, "", dtype=object)
+
+    # Final correction for  which the resolved CUSIP is associated to a blank country code
+    needs_fallback = (country_bg == "") & (case_code > -1)
+    country_fallback, fallback_code = lookup_country_fallback(fallback_table, up_cusip6_bg[needs_fallback])
+    extra_messages = get_country_fallback_messages(source_preference_order)
+    if (fallback_code == "L").any():
+        raise KeyError("L")
+    country_bg[needs_fallback] = country_fallback
+    case_code[needs_fallback] += 100
+    extra_info[needs_fallback] = [extra_messages[code] for code in fallback_code]
+
+    return pd.DataFrame({
+        'cusip6_up_bg': up_cusip6_bg,
+        'country_bg': country_bg,
+        'aggregation_case_code': case_code,
+        'cusip6_up_bg_source': up_cusip6_bg_source,
+        'country_bg_source': country_bg_source,
+        'aggregation_additional_info': extra_info
+    }, index=df.index)[assignment_columns]
+
+
+# Parity check between the columnar and the row-wise aggregation
+def check_assignment_parity(df, assignments, source_preference_order, country_details_master, logger):
+    """
+    This function reruns the row-wise decision function and compares its output with the columnar engine.
+
+    Parameters:
+        df: The input dataframe
+        assignments: The output of determine_ultimate_parent_and_country_assignment_vectorized
+        source_preference_order: Arbitrary source preference ordering (dictionary)
+        country_details_master: A dictionary listing each source's country assignment for a given CUSIP6
+        logger: Logger object
+
+    Returns:
+        A dataframe with the mismatching rows from both implementations
+    """
+    row_results = df.progress_apply(lambda x:
+        determine_ultimate_parent_and_country_assignment(x, source_preference_order, country_details_master), axis=1)
+    row_assignments = pd.DataFrame(list(row_results), index=df.index, columns=assignment_columns)
+    mismatch = (row_assignments != assignments[assignment_columns]).any(axis=1)
+    order_dependent = mismatch & row_assignments.aggregation_case_code.isin(two_majority_case_codes)
+    mismatches = row_assignments[mismatch].join(assignments[mismatch], rsuffix="_vectorized")
+
+    logger.info("Parity check: {} mismatching rows out of {} ({} in two-majority cases)".format(
+        mismatch.sum(), df.shape[0], order_dependent.sum()))
+    if mismatch.sum() > 0:
+        logger.info(mismatches.head(20).to_string())
+    if (mismatch & ~order_dependent).sum() > 0:
+        raise Exception("Columnar UP aggregation does not match row-wise rules for {} rows".format(
+            (mismatch & ~order_dependent).sum()))
+    return mismatches
+
+
 # Main routine
 if __name__ == "__main__":
 
@@ -588,8 +890,12 @@ if __name__ == "__main__":
     # Parse command line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--datapath", type=str, help="MNS data path")
+    parser.add_argument("-c", "--paritycheck", type=int, default=0, help="Whether to check the columnar aggregation against the row-wise rules (boolean flag)")
+    parser.add_argument("-s", "--statacache", type=int, default=1, help="Whether to cache Stata inputs in columnar format (boolean flag)")
     args = parser.parse_args()
     mns_data = args.datapath
+    parity_check = bool(args.paritycheck)
+    stata_cache_dir = os.path.join(mns_data, "temp/stata_cache") if args.statacache else None
     
     # Set up logging
     logger = logging.getLogger(__name__)
@@ -603,24 +909,27 @@ if __name__ == "__main__":
 
     # Load datasets
     logger.info("Reading data")
-    ms_modal_country = pd.read_stata(os.path.join(mns_data, "temp/Internal_Country_NonUS_US.dta"))
-    orbis = pd.read_stata(os.path.join(mns_data, "temp/orbis/bvd_up_compact_latest_only.dta"))
-    sdc = pd.read_stata(os.path.join(mns_data, "temp/SDC/datasets/sdc_cusip6_bg.dta"))
-    sdc_country = pd.read_stata(os.path.join(mns_data, "temp/SDC/additional/cusip6_country_sdc.dta"))
-    cgs = pd.read_stata(os.path.join(mns_data, "temp/cgs/cgs_compact_complete.dta"))
-    cgs_ai = pd.read_stata(os.path.join(mns_data, "temp/cgs/ai_master_for_up_aggregation.dta"))
-    ciq = pd.read_stata(os.path.join(mns_data, "temp/ciq/ciq_bg_cusip.dta"))
-    dealogic = pd.read_stata(os.path.join(mns_data, "temp/dealogic/dealogic_aggregation_file.dta"))
-    factset = pd.read_stata(os.path.join(mns_data, "temp/factset/factset_cusip6_bg.dta"))
+    ms_modal_country = read_stata_cached(os.path.join(mns_data, "temp/Internal_Country_NonUS_US.dta"), stata_cache_dir, logger=logger)
+    orbis = read_stata_cached(os.path.join(mns_data, "temp/orbis/bvd_up_compact_latest_only.dta"), stata_cache_dir, logger=logger)
+    sdc = read_stata_cached(os.path.join(mns_data, "temp/SDC/datasets/sdc_cusip6_bg.dta"), stata_cache_dir, logger=logger)
+    sdc_country = read_stata_cached(os.path.join(mns_data, "temp/SDC/additional/cusip6_country_sdc.dta"), stata_cache_dir, logger=logger)
+    cgs = read_stata_cached(os.path.join(mns_data, "temp/cgs/cgs_compact_complete.dta"), stata_cache_dir, logger=logger)
+    cgs_ai = read_stata_cached(os.path.join(mns_data, "temp/cgs/ai_master_for_up_aggregation.dta"), stata_cache_dir, logger=logger)
+    ciq = read_stata_cached(os.path.join(mns_data, "temp/ciq/ciq_bg_cusip.dta"), stata_cache_dir, logger=logger)
+    dealogic = read_stata_cached(os.path.join(mns_data, "temp/dealogic/dealogic_aggregation_file.dta"), stata_cache_dir, logger=logger)
+    factset = read_stata_cached(os.path.join(mns_data, "temp/factset/factset_cusip6_bg.dta"), stata_cache_dir, logger=logger)
 
     # Adjust names
     ms_modal_country = ms_modal_country.rename(columns={'iso_country_code': 'ms_country'})
     cgs = cgs.rename(columns={'domicile': 'cgs_domicile'})
 
     # Load additional company names datasets
-    ciq_names = pd.read_stata(os.path.join(mns_data, "temp/ciq/ciq_up_names.dta"), columns=['cusip6', 'companyname']).drop_duplicates()
-    sdc_names = pd.read_stata(os.path.join(mns_data, "temp/SDC/datasets/sdc_appended.dta"), columns=['CUSIP', 'Issuer']).drop_duplicates()
-    dlg_names = pd.read_stata(os.path.join(mns_data, "temp/dealogic/dealogic_aggregation_file.dta"), columns=['CUSIP', 'name']).drop_duplicates()
+    ciq_names = read_stata_cached(os.path.join(mns_data, "temp/ciq/ciq_up_names.dta"), stata_cache_dir,
+        columns=['cusip6', 'companyname'], logger=logger).drop_duplicates()
+    sdc_names = read_stata_cached(os.path.join(mns_data, "temp/SDC/datasets/sdc_appended.dta"), stata_cache_dir,
+        columns=['CUSIP', 'Issuer'], logger=logger).drop_duplicates()
+    dlg_names = dealogic[['CUSIP', 'name']].drop_duplicates()
+    log_cache_summary(logger)
     sdc_names = sdc_names[sdc_names.CUSIP != ""]
     ciq_names = ciq_names[ciq_names.cusip6 != ""]
     dlg_names = dlg_names[dlg_names.CUSIP != ""]
@@ -641,18 +950,24 @@ if __name__ == "__main__":
     ##########################################################################################
 
     # Make everything stationary
-    logger.info("Stationary transformation: SDC")
-    sdc = flatten_parent_child_map(sdc, "cusip6", "cusip6_bg", logger)
-    logger.info("Stationary transformation: CIQ")
-    ciq_stationary = flatten_parent_child_map(ciq, "cusip6", "ciqup_cusip6", logger)
-    logger.info("Stationary transformation: BVD")
-    orbis_stationary = flatten_parent_child_map(orbis, "bvdid_cusip6", "guo50_cusip6", logger)
-    logger.info("Stationary transformation: AI")
-    cgs_ai_stationary = flatten_parent_child_map(cgs_ai, "issuer_number", "ai_parent_issuer_num", logger)
-    logger.info("Stationary transformation: Dealogic")
-    dealogic_stationary = flatten_parent_child_map(dealogic, "CUSIP", "p_CUSIP", logger)
-    logger.info("Stationary transformation: Factset")
-    factset_stationary = flatten_parent_child_map(factset, "cusip6", "cusip6_bg", logger)
+    with stage_timer("flatten_parent_child_map", logger, rows=sdc.shape[0], source="sdc"):
+        logger.info("Stationary transformation: SDC")
+        sdc = flatten_parent_child_map(sdc, "cusip6", "cusip6_bg", logger)
+    with stage_timer("flatten_parent_child_map", logger, rows=ciq.shape[0], source="ciq"):
+        logger.info("Stationary transformation: CIQ")
+        ciq_stationary = flatten_parent_child_map(ciq, "cusip6", "ciqup_cusip6", logger)
+    with stage_timer("flatten_parent_child_map", logger, rows=orbis.shape[0], source="bvd"):
+        logger.info("Stationary transformation: BVD")
+        orbis_stationary = flatten_parent_child_map(orbis, "bvdid_cusip6", "guo50_cusip6", logger)
+    with stage_timer("flatten_parent_child_map", logger, rows=cgs_ai.shape[0], source="ai"):
+        logger.info("Stationary transformation: AI")
+        cgs_ai_stationary = flatten_parent_child_map(cgs_ai, "issuer_number", "ai_parent_issuer_num", logger)
+    with stage_timer("flatten_parent_child_map", logger, rows=dealogic.shape[0], source="dlg"):
+        logger.info("Stationary transformation: Dealogic")
+        dealogic_stationary = flatten_parent_child_map(dealogic, "CUSIP", "p_CUSIP", logger)
+    with stage_timer("flatten_parent_child_map", logger, rows=factset.shape[0], source="fds"):
+        logger.info("Stationary transformation: Factset")
+        factset_stationary = flatten_parent_child_map(factset, "cusip6", "cusip6_bg", logger)
 
     # Merge back with original details
     ciq = ciq_stationary.merge(ciq[['ciqup_cusip6', 'ciq_country_bg']].drop_duplicates(), on="ciqup_cusip6", how="left")
@@ -832,7 +1147,8 @@ if __name__ == "__main__":
         step5[['issuer_number', 'country_ms', 'country_ai']].drop_duplicates(), left_on='cusip6_up', right_on='issuer_number', how='outer'
     ).drop(['cusip6_up'], axis=1)
     country_detail_master = country_detail_master.merge(step6[['issuer_number', 'country_ms_ai', 'cgs_domicile']], how="left").fillna("")
-    country_detail_master = country_detail_master.set_index("issuer_number").to_dict(orient="index")
+    country_detail_frame = country_detail_master.set_index("issuer_number")
+    country_detail_master = country_detail_frame.to_dict(orient="index")
 
     # Now we harmonize the country codes for the UP sources, so that after this step the fields country_* have no conflicts
     step8 = step7.copy()
@@ -982,7 +1298,8 @@ if __name__ == "__main__":
     }
 
     # Resolve cross-source ownership chains
-    step9 = resolve_cross_ownership_chains(step8, overwrites, complementary_sources, source_preference_order, logger)
+    with stage_timer("resolve_cross_ownership_chains", logger, rows=step8.shape[0]):
+        step9 = resolve_cross_ownership_chains(step8, overwrites, complementary_sources, source_preference_order, logger)
 
     ##########################################################################################
     # Running the aggregation function
@@ -990,23 +1307,23 @@ if __name__ == "__main__":
 
     # Run the aggregation
     logger.info("Running final aggregation")
-    assignment_results = step9.progress_apply(lambda x:
-        determine_ultimate_parent_and_country_assignment(x, source_preference_order, country_detail_master), axis=1)
-    cusip6_up_bg = [x[0] for x in assignment_results]
-    country_bg = [x[1] for x in assignment_results]
-    status_codes = [x[2] for x in assignment_results]
-    cusip6_up_bg_source = [x[3] for x in assignment_results]
-    country_bg_source = [x[4] for x in assignment_results]
-    additional_info = [x[5] for x in assignment_results]
+    with stage_timer("determine_ultimate_parent_and_country_assignment", logger, rows=step9.shape[0]):
+        assignment_results = determine_ultimate_parent_and_country_assignment_vectorized(step9,
+            source_preference_order, country_detail_frame)
+
+    # Optionally compare with the row-wise decision function
+    if parity_check:
+        logger.info("Checking final aggregation against row-wise rules")
+        check_assignment_parity(step9, assignment_results, source_preference_order, country_detail_master, logger)
 
     # Add the output to the dataframe
     logger.info("Storing results")
-    step9['cusip6_up_bg'] = cusip6_up_bg
-    step9['aggregation_case_code'] = status_codes
-    step9['country_bg'] = country_bg
-    step9['aggregation_additional_info'] = additional_info
-    step9['cusip6_up_bg_source'] = cusip6_up_bg_source
-    step9['country_bg_source'] = country_bg_source
+    step9['cusip6_up_bg'] = assignment_results['cusip6_up_bg'].values
+    step9['aggregation_case_code'] = assignment_results['aggregation_case_code'].values
+    step9['country_bg'] = assignment_results['country_bg'].values
+    step9['aggregation_additional_info'] = assignment_results['aggregation_additional_info'].values
+    step9['cusip6_up_bg_source'] = assignment_results['cusip6_up_bg_source'].values
+    step9['country_bg_source'] = assignment_results['country_bg_source'].values
 
     # Adjust corner cases
     countries_resolve = uniques[uniques.n_us > 1].reset_index()
@@ -1104,7 +1421,8 @@ if __name__ == "__main__":
             raise Exception("Parent {} not found in step10 data".format(parent))
 
     # Ensure stationarity
-    map_stationary = flatten_parent_child_map(step10, "issuer_number", "cusip6_up_bg", logger)
+    with stage_timer("flatten_parent_child_map", logger, rows=step10.shape[0], source="up"):
+        map_stationary = flatten_parent_child_map(step10, "issuer_number", "cusip6_up_bg", logger)
     step11 = step10[step10.issuer_number.isin(map_stationary.issuer_number)].merge(
     map_stationary.rename(columns={'cusip6_up_bg': 'u_cusip6_up_bg'}), on="issuer_number", how="left")
     terminal_in = step11[step11.cusip6_up_bg != step11.u_cusip6_up_bg].issuer_number
@@ -20,6 +20,8 @@ import sys
 from tqdm import tqdm, tqdm_pandas
 tqdm.pandas()
 
+from Project_Constants import tax_havens
+
 
 # Constant used to indicate cycles
 cycle_constant = "__CYCLE__"
@@ -30,6 +32,11 @@ def flatten_parent_child_map(df, child_col, parent_col, logger):
     """ This function generates a stationary transformation of arbitrary
     child-to-parent mappings.
 
+    Identifiers are factorized into a parent array, and ultimate parents are found by pointer 
+    jumping until a fixed point is reached. Chains that end in a cycle are discarded. Where a
+    child is reported with several parents, each reported parent is resolved separately, but
+    chains passing through that child follow its first reported parent.
+
     Parameters:
         df: The input dataframe
         child_col: Column identifying the child 
@@ -40,67 +47,77 @@ def flatten_parent_child_map(df, child_col, parent_col, logger):
         A dataframe with the flattened child-parent map
     """
 
-    # Helper for stationary transformation
-    def _find_stationary_outcome(row, colname, i_max):
-
-        values = list(row[['{}_{}'.format(colname, i) for i in range(i_max)]])
-        if values[-1] == values[-2] == values[-3] == values[-4]:
-            return values[-1]
-        else:
-            return cycle_constant
-
-    singletons = list(set(df[parent_col]) - set(df[child_col]))
-
-    extras = pd.DataFrame({
-        child_col: singletons,
-        parent_col: singletons
-    })
-
-    tmp_df = pd.concat(
-        [df.dropna(), extras], axis=0, sort=False
-    ).rename(
-        columns={parent_col: "{}_1".format(parent_col), child_col: "{}_0".format(parent_col)}
-    )
-
-    for i in range(2,15):
-        tmp_df = tmp_df.merge(
-            tmp_df[['{}_{}'.format(parent_col, i-2), "{}_{}".format(parent_col, i-1)]].drop_duplicates(), 
-            left_on="{}_{}".format(parent_col, i-1), right_on="{}_{}".format(parent_col, i-2), how="left", 
-            suffixes=("", "_{}".format(i))
-        ).drop(
-            ["{}_{}_{}".format(parent_col, i-2, i)], axis=1
-        ).rename(
-            columns={"{}_{}_{}".format(parent_col, i-1, i): "{}_{}".format(parent_col, i)}
-        )
-        
-    tmp_df['stationary_outcome'] = tmp_df.progress_apply(lambda x: _find_stationary_outcome(x, parent_col, i), axis=1)
-    n_cycles = tmp_df[tmp_df.stationary_outcome == cycle_constant].shape[0]
+    # Parents that never appear as children map to themselves
+    pairs = df[df.notna().all(axis=1)]
+    singletons = list(set(df[parent_col].dropna()) - set(df[child_col]))
+    child_values = np.concatenate([pairs[child_col].values.astype(object), np.array(singletons, dtype=object)])
+    parent_values = np.concatenate([pairs[parent_col].values.astype(object), np.array(singletons, dtype=object)])
+
+    # Integer-coded parent array
+    codes, uniques = pd.factorize(np.concatenate([child_values, parent_values]))
+    uniques = np.asarray(uniques, dtype=object)
+    child_codes, parent_codes = codes[:len(child_values)], codes[len(child_values):]
+    n_nodes = len(uniques)
+    parent = np.arange(n_nodes)
+    first_children, first_ix = np.unique(child_codes, return_index=True)
+    parent[first_children] = parent_codes[first_ix]
+    n_multi = (np.bincount(np.unique(child_codes.astype(np.int64) * n_nodes + parent_codes) // n_nodes,
+        minlength=n_nodes) > 1).sum()
+    if n_multi > 0:
+        logger.info("WARNING: {} children have more than one parent".format(n_multi))
+
+    # Children whose own rows were dropped for missing fields cannot be resolved further
+    broken = np.zeros(n_nodes, dtype=bool)
+    broken_ix = pd.Index(uniques).get_indexer(list(set(df[child_col]) - set(child_values)))
+    broken[broken_ix[broken_ix > -1]] = True
+
+    # Pointer jumping: after k rounds, ancestor is 2^k hops up the chain (or the chain's root)
+    is_root = parent == np.arange(n_nodes)
+    ancestor = parent.copy()
+    depth = (~is_root).astype(np.int64)
+    for _ in range(int(np.ceil(np.log2(max(n_nodes, 2)))) + 1):
+        next_ancestor = ancestor[ancestor]
+        if (next_ancestor == ancestor).all():
+            break
+        depth = depth + depth[ancestor]
+        ancestor = next_ancestor
+
+    # Chains whose ancestor is not a root are cyclical
+    row_ancestor = ancestor[parent_codes]
+    stationary = is_root[row_ancestor] & ~broken[row_ancestor]
+    row_depth = depth[parent_codes] + (child_codes != parent_codes)
+    n_cycles = (~stationary).sum()
     logger.info("WARNING: Discarding {} rows out of {} due to cycles".format(n_cycles, df.shape[0]))
-    tmp_df = tmp_df[tmp_df.stationary_outcome != cycle_constant][["{}_0".format(parent_col), "stationary_outcome"]].rename(
-        columns={"{}_0".format(parent_col): child_col, "stationary_outcome": parent_col}
-    )
+    logger.info("{} rows resolved through chains longer than the 10 hops covered by the former fixed-depth merge".format(
+        (stationary & (row_depth > 10)).sum()))
+
+    tmp_df = pd.DataFrame({
+        child_col: child_values,
+        'stationary_outcome': np.where(stationary, uniques[row_ancestor], cycle_constant)
+    }, columns=[child_col, 'stationary_outcome'])
+    tmp_df = tmp_df[tmp_df.stationary_outcome != cycle_constant].rename(columns={"stationary_outcome": parent_col})
     return tmp_df
 
 
 # Graph utility to detect presence cycles in a list of elements
 def detect_cycle(lst):
-    visited  = []
+    visited = set()
     for i in range(len(lst)):
         if lst[i] in visited:
             return True
-        visited.append(lst[i])
+        visited.add(lst[i])
     return False
 
 
 # Graph utility to detect identity of circular entries in a list of elements
 def get_circular_elements(lst):
-    visited  = []
-    circular = []
+    visited = set()
+    circular = set()
     for i in range(len(lst)):
         if lst[i] in visited:
-            circular.append(lst[i])
-        visited.append(lst[i])
-    return list(set(circular))
+            circular.add(lst[i])
+        visited.add(lst[i])
+    return list(circular)
 
 
 # Helper function for country conflict resolution
@@ -311,158 +328,129 @@ def get_multiple_modes(array):
 def resolve_cross_ownership_chains(df_in, overwrites, complementary_sources, source_preference_order, logger):
     """ This function resolves cross-source ownership chains.
 
+    Each (source, CUSIP6) row in overwrites is a node of a single parent graph; its outgoing edge points
+    to the parent reported by the complementary sources. All chains are walked simultaneously for at most
+    maxiter hops, after which cycles are broken and tax haven parents are pruned.
+
     Parameters:
         df_in: The input dataframe
+        overwrites: Dictionary of dataframes, by source, of UP codes that conflict with other sources
+        complementary_sources: Dictionary listing, by source, the other four sources
+        source_preference_order: Arbitrary source preference ordering (dictionary)
+        logger: Logger object
 
     Returns: 
         A dataframe with the resolved ownership chains
     """
 
-    # Resolve entry hierarchy
-    resolved_chains = {}
-    for source in ['bvd', 'sdc', 'ciq', 'dlg', 'fds']:
-
-        logger.info("Processing source {}".format(source))
-        ownership_chain = {}
-
-        for ix in tqdm(range(overwrites[source].shape[0])):
-
-            # Chain structure
-            # Elements of the form (cusip6_up, country, source, used_preference_order)
-            ownership_chain[ix] = []
-
-            # Some book-keeping
-            done = False
-            maxiter = 10
-            next_source = source
-            i = 0
-
-            # Read first-level info
-            x_source, y_source, z_source, o_source = (complementary_sources[source][0], complementary_sources[source][1], 
-                                                      complementary_sources[source][2], complementary_sources[source][3])
-            orig_up_cusip6 = overwrites[source].iloc[ix]['cusip6_up_{}'.format(source)]
-            orig_country = overwrites[source].iloc[ix]['country_{}'.format(source)]
-            x_res = overwrites[source].iloc[ix]['cusip6_up_{}_y'.format(x_source)]
-            y_res = overwrites[source].iloc[ix]['cusip6_up_{}_y'.format(y_source)]
-            z_res = overwrites[source].iloc[ix]['cusip6_up_{}_y'.format(z_source)]
-            o_res = overwrites[source].iloc[ix]['cusip6_up_{}_y'.format(o_source)]
-            x_country = overwrites[source].iloc[ix]['country_{}_y'.format(x_source)]
-            y_country = overwrites[source].iloc[ix]['country_{}_y'.format(y_source)]
-            z_country = overwrites[source].iloc[ix]['country_{}_y'.format(z_source)]
-            o_country = overwrites[source].iloc[ix]['country_{}_y'.format(o_source)]
-            ownership_chain[ix].append((orig_up_cusip6, orig_country, source, False))
-
-            while not done and i < maxiter:
-
-                # Read next-level parents
-                if i > 0:
-                    try:
-                        next_row = overwrites[next_source][overwrites[next_source]['cusip6_up_{}'.format(next_source)] == next_cusip].iloc[0]
-                    except IndexError:
-                        done = True
-                        continue
-                    orig_up_cusip6 = next_cusip
-                    orig_country = next_row['country_{}'.format(next_source)]
-                    x_source, y_source, z_source, o_source = (complementary_sources[next_source][0], complementary_sources[next_source][1], 
-                                                              complementary_sources[next_source][2], complementary_sources[next_source][3])
-                    x_res = next_row['cusip6_up_{}_y'.format(x_source)]
-                    y_res = next_row['cusip6_up_{}_y'.format(y_source)]
-                    z_res = next_row['cusip6_up_{}_y'.format(z_source)]
-                    o_res = next_row['cusip6_up_{}_y'.format(o_source)]
-                    x_country = next_row['country_{}_y'.format(x_source)]
-                    y_country = next_row['country_{}_y'.format(y_source)]
-                    z_country = next_row['country_{}_y'.format(z_source)]
-                    o_country = next_row['country_{}_y'.format(o_source)]
-
-                # Check if we have multiple parents
-                used_pref_order_l0 = ownership_chain[ix][-1][3]
-                if sum([x != "" for x in [x_res, y_res, z_res, o_res]]) > 1 and len(set(x for x in [x_res, y_res, z_res, o_res] if x != "")) > 1:
-                    double_parent = True
-                    used_pref_order_l0 = True
-                else:
-                    double_parent = False
-
-                # Determine which source to traverse
-                if ((orig_up_cusip6 == x_res and orig_up_cusip6 == y_res and orig_up_cusip6 == z_res and orig_up_cusip6 == o_res) or 
-                    (orig_up_cusip6 == x_res and y_res == "" and z_res == "" and o_res == "") or
-                    (orig_up_cusip6 == y_res and x_res == "" and z_res == "" and o_res == "") or
-                    (orig_up_cusip6 == z_res and x_res == "" and y_res == "" and o_res == "") or
-                    (orig_up_cusip6 == o_res and x_res == "" and y_res == "" and z_res == "")):
-                    done = True
-                elif x_res != "" and y_res == "" and z_res == "" and o_res == "":
-                    ownership_chain[ix].append((x_res, x_country, x_source, used_pref_order_l0))
-                    next_source = x_source
-                    next_cusip = x_res
-                elif y_res != "" and x_res == "" and z_res == "" and o_res == "":
-                    ownership_chain[ix].append((y_res, y_country, y_source, used_pref_order_l0))
-                    next_source = y_source
-                    next_cusip = y_res
-                elif z_res != "" and y_res == "" and x_res == "" and o_res == "":
-                    ownership_chain[ix].append((z_res, z_country, z_source, used_pref_order_l0))
-                    next_source = z_source
-                    next_cusip = z_res
-                elif o_res != "" and y_res == "" and x_res == "" and z_res == "":
-                    ownership_chain[ix].append((o_res, o_country, o_source, used_pref_order_l0))
-                    next_source = o_source
-                    next_cusip = o_res
-                else:
-                    min_pref_order = min([
-                        source_preference_order[x_source], source_preference_order[y_source], source_preference_order[z_source], source_preference_order[o_source]
-                    ])
-                    if source_preference_order[x_source] == min_pref_order:
-                        ownership_chain[ix].append((x_res, x_country, x_source, used_pref_order_l0))
-                        next_source = x_source
-                        next_cusip = x_res
-                    elif source_preference_order[y_source] == min_pref_order:
-                        ownership_chain[ix].append((y_res, y_country, y_source, used_pref_order_l0))
-                        next_source = y_source
-                        next_cusip = y_res
-                    elif source_preference_order[z_source] == min_pref_order:
-                        ownership_chain[ix].append((z_res, z_country, z_source, used_pref_order_l0))
-                        next_source = z_source
-                        next_cusip = z_res
-                    else:
-                        ownership_chain[ix].append((o_res, o_country, o_source, used_pref_order_l0))
-                        next_source = o_source
-                        next_cusip = o_res
-                    
-                # Check if done
-                if not done and orig_up_cusip6 == next_cusip:
-                    done = True
-
-                # Augment counter
-                i += 1
-
-        # Final processing
-        decycled_ownership_chain = {}
-        for ix in tqdm(ownership_chain.keys()):
-
-            # Now break cycles according to preference ordering
-            if detect_cycle(ownership_chain[ix]):
-                circular = get_circular_elements(ownership_chain[ix])
-                pri_index = 100
-                preferred_source_ix = -1
-                preferred_source = ""
-                for i in range(len(circular)):
-                    lev_source = circular[i][2]
-                    if source_preference_order[lev_source] < pri_index:
-                        preferred_source = lev_source
-                        preferred_source_ix = i
-                resolved_chain = [ownership_chain[ix][0], (circular[preferred_source_ix][0], circular[preferred_source_ix][1], preferred_source, True)]
-                chain_final = resolved_chain
-            else:
-                chain_final = ownership_chain[ix]
-
-            # Now pop tax haven parents until we get to the topmost non-FP element of the chain
-            stop_pruning = False
-            while len(chain_final) > 0 and not stop_pruning:
-                if chain_final[-1][1] not in tax_havens:
-                    stop_pruning = True
-                else:
-                    chain_final.pop()
-            decycled_ownership_chain[ix] = chain_final
-
-        resolved_chains[source] = decycled_ownership_chain
+    # Some book-keeping
+    chain_sources = ['bvd', 'sdc', 'ciq', 'dlg', 'fds']
+    maxiter = 10
+
+    # Build the parent graph; nodes are ordered by source, then by their row in overwrites
+    node_source, node_cusip, node_country = [], [], []
+    node_done, node_double_parent = [], []
+    next_cusip, next_country, next_source = [], [], []
+    for source in chain_sources:
+
+        comp_sources = complementary_sources[source]
+        orig_up_cusip6 = overwrites[source]['cusip6_up_{}'.format(source)].values
+        parent_cusip6 = overwrites[source][['cusip6_up_{}_y'.format(x) for x in comp_sources]].values
+        parent_country = overwrites[source][['country_{}_y'.format(x) for x in comp_sources]].values
+        rows = np.arange(len(orig_up_cusip6))
+
+        # Check if we have multiple parents
+        nonblank = parent_cusip6 != ""
+        n_nonblank = nonblank.sum(axis=1)
+        distinct_parents = np.zeros(len(rows), dtype=bool)
+        for (i, j) in itertools.combinations(range(len(comp_sources)), 2):
+            distinct_parents |= nonblank[:, i] & nonblank[:, j] & (parent_cusip6[:, i] != parent_cusip6[:, j])
+
+        # Chains end at nodes whose only (or every) parent is the node itself
+        is_self = parent_cusip6 == orig_up_cusip6[:, None]
+        done = is_self.all(axis=1) | ((n_nonblank == 1) & (is_self & nonblank).any(axis=1))
+
+        # Determine which source to traverse: the only non-blank parent, else the preferred source
+        preferred_ix = np.argmin([source_preference_order[x] for x in comp_sources])
+        traverse_ix = np.where(n_nonblank == 1, np.argmax(nonblank, axis=1), preferred_ix)
+
+        node_source.append(np.full(len(rows), source, dtype=object))
+        node_cusip.append(orig_up_cusip6)
+        node_country.append(overwrites[source]['country_{}'.format(source)].values)
+        node_done.append(done)
+        node_double_parent.append((n_nonblank > 1) & distinct_parents)
+        next_cusip.append(parent_cusip6[rows, traverse_ix])
+        next_country.append(parent_country[rows, traverse_ix])
+        next_source.append(np.array(comp_sources, dtype=object)[traverse_ix])
+
+    node_source, node_cusip, node_country = [np.concatenate(x).astype(object) for x in [node_source, node_cusip, node_country]]
+    next_cusip, next_country, next_source = [np.concatenate(x).astype(object) for x in [next_cusip, next_country, next_source]]
+    node_done, node_double_parent = np.concatenate(node_done), np.concatenate(node_double_parent)
+    node_keys = pd.Index(pd.Series(node_source) + ":" + pd.Series(node_cusip))
+    next_node = node_keys.get_indexer(pd.Series(next_source) + ":" + pd.Series(next_cusip))
+    n_nodes = len(node_cusip)
+    rows = np.arange(n_nodes)
+    logger.info("Resolving ownership chains for {} nodes".format(n_nodes))
+
+    # Walk all chains at once; elements are (cusip6_up, country, source, used_preference_order)
+    chain_cusip = np.full((n_nodes, maxiter + 1), "", dtype=object)
+    chain_country = np.full((n_nodes, maxiter + 1), "", dtype=object)
+    chain_source = np.full((n_nodes, maxiter + 1), "", dtype=object)
+    chain_used_pref = np.zeros((n_nodes, maxiter + 1), dtype=bool)
+    chain_cusip[:, 0], chain_country[:, 0], chain_source[:, 0] = node_cusip, node_country, node_source
+    chain_length = np.ones(n_nodes, dtype=int)
+    current = rows.copy()
+    active = np.ones(n_nodes, dtype=bool)
+    used_pref = np.zeros(n_nodes, dtype=bool)
+    for i in range(maxiter):
+        advance = active & ~node_done[current]
+        used_pref = used_pref | (advance & node_double_parent[current])
+        chain_cusip[advance, i + 1] = next_cusip[current[advance]]
+        chain_country[advance, i + 1] = next_country[current[advance]]
+        chain_source[advance, i + 1] = next_source[current[advance]]
+        chain_used_pref[advance, i + 1] = used_pref[advance]
+        chain_length[advance] += 1
+        active = advance & (next_cusip[current] != node_cusip[current]) & (next_node[current] > -1)
+        current = np.where(active, next_node[current], current)
+    logger.info("{} chains reached the maximum depth of {}".format((chain_length == maxiter + 1).sum(), maxiter))
+
+    # Detect cycles, i.e. chain elements that appear more than once
+    positions = np.arange(maxiter + 1)
+    element_codes = np.zeros((n_nodes, maxiter + 1), dtype=np.int64)
+    for values in [chain_cusip, chain_country, chain_source]:
+        codes, uniques = pd.factorize(values.ravel())
+        element_codes = element_codes * (len(uniques) + 1) + codes.reshape(values.shape)
+    element_codes = element_codes * 2 + chain_used_pref
+    element_codes = np.where(positions[None, :] < chain_length[:, None], element_codes, -1 - positions[None, :])
+    circular = (element_codes[:, :, None] == element_codes[:, None, :]).sum(axis=2) > 1
+    has_cycle = circular.any(axis=1)
+    logger.info("Breaking {} cyclical chains".format(has_cycle.sum()))
+
+    # Now break cycles according to preference ordering: the chain is replaced by its first element and
+    # the circular element with the most preferred source
+    chain_pref = pd.Series(chain_source.ravel()).map(source_preference_order).fillna(0).values.reshape(chain_source.shape)
+    preferred_ix = np.argmin(np.where(circular, chain_pref * (maxiter + 1) + positions[None, :], np.inf), axis=1)
+    cycle_rows = rows[has_cycle]
+    for values in [chain_cusip, chain_country, chain_source]:
+        values[cycle_rows, 1] = values[cycle_rows, preferred_ix[has_cycle]]
+    chain_used_pref[cycle_rows, 1] = True
+    chain_length[cycle_rows] = 2
+
+    # Now pop tax haven parents until we get to the topmost non-FP element of the chain
+    chain_nfp = (positions[None, :] < chain_length[:, None]) & \
+        ~pd.Series(chain_country.ravel()).isin(tax_havens).values.reshape(chain_country.shape)
+    has_nfp = chain_nfp.any(axis=1)
+    top_ix = maxiter - np.argmax(chain_nfp[:, ::-1], axis=1)
+
+    # Correspondence tables between each node and its resolved parent
+    resolved_chains = pd.DataFrame({
+        'node_source': node_source,
+        'orig_cusip6': node_cusip,
+        'parent_cusip6': chain_cusip[rows, top_ix],
+        'parent_country': chain_country[rows, top_ix],
+        'overwrite_source': chain_source[rows, top_ix],
+        'used_pref_ordering_for_parent_resolution_new': chain_used_pref[rows, top_ix]
+    })[has_nfp]
 
     # Perform overwrites from unwound hierarchies
     df_out = df_in.copy()
@@ -471,28 +459,8 @@ def resolve_cross_ownership_chains(df_in, overwrites, complementary_sources, sou
 
     for source in ['bvd', 'ciq', 'sdc', 'dlg', 'fds']:
 
-        orig_cusip6 = []
-        parent_cusip6 = []
-        parent_country = []
-        overwrite_source = []
-        used_pref_ordering_for_parent_resolution = []
-
-        for i in range(len(resolved_chains[source])):
-            element = resolved_chains[source][i]
-            if len(element) > 0:
-                orig_cusip6.append(element[0][0])
-                parent_cusip6.append(element[-1][0])
-                parent_country.append(element[-1][1])
-                overwrite_source.append(element[-1][2])
-                used_pref_ordering_for_parent_resolution.append(element[-1][3])
-
-        correspondence_table = pd.DataFrame({
-            'orig_cusip6': orig_cusip6,
-            'parent_cusip6': parent_cusip6,
-            'parent_country': parent_country,
-            'overwrite_source': overwrite_source,
-            'used_pref_ordering_for_parent_resolution_new': used_pref_ordering_for_parent_resolution
-        })
+        correspondence_table = resolved_chains[resolved_chains.node_source == source].drop(
+            ['node_source'], axis=1).reset_index(drop=True)
 
         correspondence_tables[source] = correspondence_table
 
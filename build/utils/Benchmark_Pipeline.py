@@ -0,0 +1,372 @@
+# --------------------------------------------------------------------------------------------------
+# Benchmark_Pipeline
+#
+# This file benchmarks the hot paths of the Python build jobs on synthetic, MNS-shaped data of
+# configurable scale:
+#   - flatten_parent_child_map and resolve_cross_ownership_chains (UP_Helper)
+#   - determine_ultimate_parent_and_country_assignment (UP_Aggregation, vectorized version)
+#   - the unwinding merges (Unwind_MF_Positions_Step1)
+#   - run_prepass, find_fullpass_matches and concatenate_matches (Fuzzy_Merge_Find_Matches)
+#
+# Each stage is run in a separate process and reported as one JSON record per line, with the same
+# fields as the [stage] records in the production logs (see stage_timer): wall time, peak resident
+# memory and rows per second.
+#
+# Notes:
+#   - The UP and unwinding stages require the Python 3 environment, while the fuzzy stages require
+#     the Python 2 environment (dedupe). Stages that cannot be imported are reported as skipped.
+#   - The fuzzy stages use a stand-in linker (simple comparators with fixed logistic weights), so
+#     they measure the record handling and scheduling around the linker rather than a trained
+#     dedupe model. Peak memory of the fuzzy stages does not include pool workers (-c/--cpus > 1).
+# --------------------------------------------------------------------------------------------------
+from __future__ import print_function
+import os
+import sys
+import json
+import logging
+import argparse
+import platform
+import subprocess
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+
+build_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(build_path, "utils"))
+sys.path.append(os.path.join(build_path, "up_aggregation"))
+sys.path.append(os.path.join(build_path, "unwind"))
+sys.path.append(os.path.join(build_path, "fuzzy"))
+from stage_timer import stage_timer, stage_records, to_json_value
+
+
+# Country codes used in the synthetic data (including tax havens and blanks)
+countries = np.array(["USA", "GBR", "DEU", "JPN", "CYM", "BMU", "HKG", "LUX", ""])
+
+
+# Synthetic CUSIP-like identifiers
+def gen_ids(prefix, n):
+    return np.array(["{}{:06d}".format(prefix, i) for i in range(n)], dtype=object)
+
+
+##########################################################################################
+# Ultimate parent aggregation
+##########################################################################################
+
+# Child-parent map: a random forest of ownership trees, with a few cycles
+def gen_parent_map(n, rng):
+    nodes = gen_ids("N", n)
+    child_idx = np.arange(1, n)
+    parent_idx = (rng.rand(n - 1) * child_idx).astype(int)
+    has_parent = rng.rand(n - 1) > 0.15
+    df = pd.DataFrame({'child': nodes[child_idx[has_parent]], 'parent': nodes[parent_idx[has_parent]]})
+    cycles = gen_ids("Z", 3 * max(n // 1000, 1))
+    df = pd.concat([df, pd.DataFrame({'child': cycles, 'parent': np.roll(cycles.reshape(-1, 3), 1, axis=1).ravel()})])
+    df['country'] = rng.choice(countries[:-1], df.shape[0])
+    return df.reset_index(drop=True)
+
+
+# Cross-source ownership chains: UP assignments of each source, with overwrites from other sources
+def gen_ownership_chains(n, rng):
+    complementary_sources = {
+        'ciq': ['bvd', 'sdc', 'dlg', 'fds'],
+        'bvd': ['sdc', 'ciq', 'dlg', 'fds'],
+        'sdc': ['bvd', 'ciq', 'dlg', 'fds'],
+        'dlg': ['ciq', 'bvd', 'sdc', 'fds'],
+        'fds': ['ciq', 'bvd', 'sdc', 'dlg']
+    }
+    cusips = gen_ids("C", n)
+    parents = cusips[:max(n // 5, 1)]
+    df = pd.DataFrame({'issuer_number': cusips})
+    overwrites = {}
+    for source in complementary_sources:
+        df['cusip6_up_' + source] = rng.choice(parents, n)
+        df['country_' + source] = rng.choice(countries, n)
+        overwrite_cusips = rng.choice(parents, len(parents) // 2, replace=False)
+        overwrite = pd.DataFrame({'cusip6_up_' + source: overwrite_cusips,
+            'country_' + source: rng.choice(countries, len(overwrite_cusips))})
+        for other in complementary_sources[source]:
+            candidates = np.where(rng.rand(len(overwrite_cusips)) < 0.5, "", rng.choice(parents, len(overwrite_cusips)))
+            overwrite['cusip6_up_{}_y'.format(other)] = candidates
+            overwrite['country_{}_y'.format(other)] = rng.choice(countries, len(overwrite_cusips))
+        overwrites[source] = overwrite.astype(object)
+    return df.astype(object), overwrites, complementary_sources
+
+
+# Pre-aggregation frame: UP and country candidates of each source, with the CGS country details
+def gen_assignment_frame(n, rng, up_sources):
+    cusips = gen_ids("A", max(n // 20, 10))
+    df = pd.DataFrame({'issuer_number': rng.choice(cusips, n)})
+    df['cusip6_up_ai'] = rng.choice(cusips, n)
+    for col in ['country_ai', 'country_ms_ai', 'cgs_domicile', 'country_ms']:
+        df[col] = rng.choice(countries, n)
+    consensus = rng.choice(cusips, n)
+    for source in up_sources:
+        candidates = np.where(rng.rand(n) < 0.5, consensus, rng.choice(cusips, n))
+        df['cusip6_up_' + source] = np.where(rng.rand(n) < 0.2, "", candidates)
+        df['country_' + source] = rng.choice(countries, n)
+    country_details = pd.DataFrame({'issuer_number': cusips})
+    for col in ['country_' + x for x in up_sources] + ['country_ai', 'country_ms_ai', 'cgs_domicile', 'country_ms']:
+        country_details[col] = rng.choice(countries[:-1], len(cusips))
+    return df.astype(object), country_details.astype(object).set_index('issuer_number')
+
+
+def run_flatten_parent_child_map(n, rng, args, logger):
+    from UP_Helper import flatten_parent_child_map
+    df = gen_parent_map(n, rng)
+    with stage_timer("flatten_parent_child_map", logger, rows=df.shape[0]):
+        flatten_parent_child_map(df, "child", "parent", logger)
+
+
+def run_resolve_cross_ownership_chains(n, rng, args, logger):
+    from UP_Helper import resolve_cross_ownership_chains
+    from Project_Constants import source_preference_order
+    df, overwrites, complementary_sources = gen_ownership_chains(n, rng)
+    with stage_timer("resolve_cross_ownership_chains", logger, rows=df.shape[0]):
+        resolve_cross_ownership_chains(df, overwrites, complementary_sources, source_preference_order, logger)
+
+
+def run_determine_ultimate_parent_and_country_assignment(n, rng, args, logger):
+    from UP_Aggregation import determine_ultimate_parent_and_country_assignment_vectorized, up_sources
+    from Project_Constants import source_preference_order
+    df, country_details = gen_assignment_frame(n, rng, up_sources)
+    with stage_timer("determine_ultimate_parent_and_country_assignment", logger, rows=df.shape[0]):
+        determine_ultimate_parent_and_country_assignment_vectorized(df, source_preference_order, country_details)
+
+
+##########################################################################################
+# Fund-in-fund unwinding
+##########################################################################################
+
+# Holdings of a half-year (NonUS and US), with fund share classes held by other funds
+def gen_holdings(n, rng, year, half, funds, fund_cusips, securities, obs_offset):
+    months = np.arange(1, 7) if half == 1 else np.arange(7, 13)
+    reports = pd.DataFrame({'MasterPortfolioId': np.repeat(funds, 2).astype(float),
+        'month': rng.choice(months, 2 * len(funds))}).drop_duplicates()
+    reports = reports.iloc[rng.choice(reports.shape[0], n)].reset_index(drop=True)
+    reports['date'] = pd.to_datetime(pd.DataFrame({'year': year, 'month': reports['month'], 'day': 1})) + pd.offsets.MonthEnd(0)
+    df = reports.drop('month', axis=1)
+    df['cusip'] = np.where(rng.rand(n) < 0.1, rng.choice(fund_cusips, n), rng.choice(securities, n))
+    df['iso_currency_code'] = "USD"
+    df['iso_country_code'] = rng.choice(countries[:-1], n)
+    df['currency_id'] = rng.choice([1., 2., 3.], n)
+    df['marketvalue'] = rng.lognormal(10, 2, n) * np.where(rng.rand(n) < 0.95, 1, -1)
+    df['mns_class'] = "E"
+    df['_obs_id'] = ["{}".format(i) for i in range(obs_offset, obs_offset + n)]
+    df['lcu_per_usd_eop'] = rng.choice([1., 0.8, 110.], n)
+    nonus = rng.rand(n) < 0.5
+    return df[nonus].reset_index(drop=True), df[~nonus].reset_index(drop=True)
+
+
+def run_unwinding_merges(n, rng, args, logger):
+    from Unwind_MF_Positions_Step1 import prepare_positions, unwind_positions
+    funds = np.arange(1, max(n // 200, 10) + 1)
+    investing_funds = funds[:max(len(funds) // 3, 1)]
+    fund_cusips = gen_ids("F", len(investing_funds))
+    links = pd.DataFrame({'cusip': fund_cusips, 'investing_mpid': investing_funds.astype(float)})
+    securities = gen_ids("S", max(n // 10, 100))
+    prev_frames = gen_holdings(n, rng, 2016, 2, funds, fund_cusips, securities, 0)
+    current_frames = gen_holdings(n, rng, 2017, 1, funds, fund_cusips, securities, n)
+    mf_positions, full_positions = prepare_positions(current_frames, prev_frames, links, logger)
+    with stage_timer("unwinding_merges", logger, rows=mf_positions.shape[0], positions=full_positions.shape[0]):
+        unwind_positions(mf_positions, full_positions, logger)
+
+
+##########################################################################################
+# Fuzzy matching
+##########################################################################################
+
+# Fields of the stand-in linker
+linker_fields = ["securityname", "coupon", "maturitydate", "iso_country_code", "currency_id", "mns_subclass"]
+
+
+# Stand-in for the trained dedupe linker
+class BenchmarkField(object):
+    def __init__(self, field):
+        self.field = field
+
+
+class BenchmarkDataModel(object):
+    primary_fields = [BenchmarkField(x) for x in linker_fields]
+
+    def distances(self, pairs):
+        distances = np.empty((len(pairs), 3))
+        for i, (x, y) in enumerate(pairs):
+            name_x, name_y = x["securityname"] or "", y["securityname"] or ""
+            distances[i, 0] = len(set(name_x.split()) ^ set(name_y.split()))
+            distances[i, 1] = abs((x["coupon"] or 0.) - (y["coupon"] or 0.))
+            distances[i, 2] = float(x["currency_id"] == y["currency_id"])
+        return distances
+
+
+class BenchmarkClassifier(object):
+    weights = np.array([-1., -0.5, 1.])
+    bias = 1.
+
+    def predict_proba(self, distances):
+        return 1. / (1. + np.exp(-(distances.dot(self.weights) + self.bias)))
+
+
+class BenchmarkLinker(object):
+    data_model = BenchmarkDataModel()
+    classifier = BenchmarkClassifier()
+    opt_threshold = 0.5
+
+
+# Security records: bad (no CUSIP) and good (with CUSIP) datapoints with overlapping fields
+def gen_security_records(n, rng):
+    words = np.array(["CORP", "INC", "HOLDINGS", "CAPITAL", "BANK", "ENERGY", "FINANCE", "GROUP",
+        "INTL", "TRUST", "SR", "NT", "BD", "MTN", "GLOBAL", "POWER", "AUTO", "TELECOM"])
+
+    def records(m, with_cusip):
+        df = pd.DataFrame({
+            'securityname': [" ".join(x) for x in rng.choice(words, (m, 3))],
+            'coupon': rng.choice([1., 2.5, 3.75, 5., 6.125, np.nan], m),
+            'maturitydate': pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.randint(0, 3650 // 30, m) * 30, unit="D"),
+            'iso_country_code': rng.choice(countries[:-1], m),
+            'currency_id': rng.choice([1., 2., 3.], m),
+            'mns_subclass': rng.choice(["BC", "BG", "BS"], m),
+            'extra_security_descriptors': "",
+            'geography': rng.choice(["US", "NonUS"], m),
+        })
+        df['securityname_raw'] = df['securityname']
+        if with_cusip:
+            df['cusip'] = gen_ids("G", m)
+        return df
+
+    return records(n, False), records(2 * n, True)
+
+
+# Set the module globals the fuzzy matching functions rely on
+def setup_fuzzy_globals(FM, args, logger):
+    FM.logger = logger
+    FM.linker = BenchmarkLinker()
+    FM.acceptance_threshold = FM.linker.opt_threshold
+    FM.num_cores = args.cpus
+    return FM.linker
+
+
+def run_run_prepass(n, rng, args, logger):
+    import Fuzzy_Merge_Find_Matches as FM
+    linker = setup_fuzzy_globals(FM, args, logger)
+    bad_data, good_data = gen_security_records(n, rng)
+    bad_data_df = bad_data.reset_index().rename(columns={'index': 'bad_data_id'})
+    good_data_df = good_data.reset_index().rename(columns={'index': 'good_data_id'})
+    matched_bad_ids, matched_good_ids = set(), set()
+    with stage_timer("run_prepass", logger, rows=bad_data_df.shape[0], rounds=len(FM.prepass_rounds["bonds"])) as stage:
+        pool = Pool(args.cpus, initializer=FM.init_prepass_worker, initargs=(linker,)) if args.cpus > 1 else None
+        for i, round_fields in enumerate(FM.prepass_rounds["bonds"]):
+            round_matches = FM.run_prepass(round_fields, matched_bad_ids, matched_good_ids, i,
+                bad_data_df, good_data_df, linker, pool=pool)
+            matched_bad_ids.update(x[0][0] for x in round_matches)
+            matched_good_ids.update(x[0][1] for x in round_matches)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        stage['matches'] = len(matched_bad_ids)
+
+
+def run_find_fullpass_matches(n, rng, args, logger):
+    import Fuzzy_Merge_Find_Matches as FM
+    from util.serialization import parse_missing_fields, df_to_dict
+    linker = setup_fuzzy_globals(FM, args, logger)
+    bad_data, good_data = gen_security_records(n, rng)
+    bad_records = parse_missing_fields(df_to_dict(bad_data[linker_fields]))
+    good_records = parse_missing_fields(df_to_dict(good_data[linker_fields]))
+
+    # Block on currency, country and leading word of the security name (up to 50 candidates)
+    block_key = lambda df: (df.currency_id.astype(str) + df.iso_country_code + df.securityname.str.split().str[0])
+    candidates = pd.DataFrame({'bad_id': bad_data.index, 'key': block_key(bad_data)}).merge(
+        pd.DataFrame({'good_id': good_data.index, 'key': block_key(good_data)}), on="key")
+    candidates = candidates.groupby('bad_id').head(50)
+    blocks = [(((b_id, bad_records[b_id], set()),), [(g_id, good_records[g_id], set()) for g_id in group.good_id.values])
+        for b_id, group in candidates.groupby('bad_id')]
+    batches = FM.get_fullpass_batches(blocks, FM.fullpass_batch_size)
+    fullpass_args = (linker, FM.acceptance_threshold, good_records)
+    with stage_timer("find_fullpass_matches", logger, rows=candidates.shape[0], blocks=len(blocks)):
+        if args.cpus > 1:
+            FM.imap_unordered_bar(FM.find_fullpass_matches, batches, args.cpus,
+                initializer=FM.init_fullpass_worker, initargs=fullpass_args)
+        else:
+            FM.init_fullpass_worker(*fullpass_args)
+            [FM.find_fullpass_matches(batch) for batch in batches]
+
+
+def run_concatenate_matches(n, rng, args, logger):
+    import Fuzzy_Merge_Find_Matches as FM
+    setup_fuzzy_globals(FM, args, logger)
+    bad_data, good_data = gen_security_records(n, rng)
+    n_matches = n // 2
+    linked_records = [((b_id, g_id), p, 0) for b_id, g_id, p in zip(
+        rng.choice(bad_data.index.values, n_matches, replace=False).tolist(),
+        rng.choice(good_data.index.values, n_matches, replace=False).tolist(),
+        rng.rand(n_matches).tolist())]
+    with stage_timer("concatenate_matches", logger, rows=len(linked_records)):
+        FM.concatenate_matches(bad_data, good_data, linked_records, save_domicile=True)
+
+
+# Benchmark stages, in pipeline order
+stages = [
+    ("flatten_parent_child_map", run_flatten_parent_child_map),
+    ("resolve_cross_ownership_chains", run_resolve_cross_ownership_chains),
+    ("determine_ultimate_parent_and_country_assignment", run_determine_ultimate_parent_and_country_assignment),
+    ("unwinding_merges", run_unwinding_merges),
+    ("run_prepass", run_run_prepass),
+    ("find_fullpass_matches", run_find_fullpass_matches),
+    ("concatenate_matches", run_concatenate_matches),
+]
+
+
+# Run a single stage in the current process and emit its records
+def run_stage(stage, stage_func, args, logger):
+    rng = np.random.RandomState(args.seed)
+    context = {'scale': args.rows, 'seed': args.seed, 'cpus': args.cpus, 'python': platform.python_version()}
+    first_record = len(stage_records)
+    try:
+        stage_func(args.rows, rng, args, logger)
+        results = stage_records[first_record:]
+    except ImportError as e:
+        results = [{'stage': stage, 'skipped': "{}".format(e)}]
+    except Exception as e:
+        results = [{'stage': stage, 'error': "{}: {}".format(type(e).__name__, e)}]
+    out = open(args.output, "a") if args.output else sys.stdout
+    for record in results:
+        record.update(context)
+        print(json.dumps(record, sort_keys=True, default=to_json_value), file=out)
+    out.flush()
+    if args.output:
+        out.close()
+
+
+# Main routine
+if __name__ == "__main__":
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--rows", type=int, default=100000, help="Scale of the synthetic data (rows per stage input)")
+    parser.add_argument("-s", "--stages", type=str, default=",".join(x[0] for x in stages), help="Comma-separated list of stages to run")
+    parser.add_argument("-r", "--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("-c", "--cpus", type=int, default=1, help="Number of cores for the fuzzy matching stages")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output file for the JSON records (appended; stdout if not set)")
+    parser.add_argument("-i", "--isolate", type=int, default=1, help="Whether to run each stage in a separate process (boolean flag)")
+    args = parser.parse_args()
+
+    # Set up logging (warnings of the benchmarked functions only)
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    logger = logging.getLogger(__name__)
+
+    stage_funcs = dict(stages)
+    selected = [x.strip() for x in args.stages.split(",") if x.strip()]
+    for stage in selected:
+        if stage not in stage_funcs:
+            raise Exception("Unknown stage {} (must be in [{}])".format(stage, ", ".join(x[0] for x in stages)))
+
+    # Run the stages, each in its own process so that peak memory is measured per stage
+    for stage in selected:
+        if args.isolate and len(selected) > 1:
+            cmd = [sys.executable, os.path.abspath(__file__), "-n", str(args.rows), "-s", stage,
+                "-r", str(args.seed), "-c", str(args.cpus), "-i", "0"]
+            if args.output:
+                cmd += ["-o", args.output]
+            subprocess.call(cmd)
+        else:
+            run_stage(stage, stage_funcs[stage], args, logger)
@@ -23,3 +23,4 @@ source activate <PYTHON3_ENV_PATH>
 pip install tqdm
 pip install tenacity
 pip install dedupe
+pip install pyarrow
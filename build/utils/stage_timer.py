@@ -0,0 +1,72 @@
+# --------------------------------------------------------------------------------------------------
+# Stage_Timer
+#
+# This file provides a context manager that times a stage of the Python build jobs and reports its
+# wall time, peak resident memory and throughput. Each stage is logged as a single JSON record
+# prefixed with "[stage]", so that the same metrics can be extracted from production logs and from
+# the benchmark suite (Benchmark_Pipeline).
+#
+# Notes:
+#   - Peak memory is the peak resident set size of the process up to the end of the stage (as per
+#     resource.getrusage); the benchmark suite runs each stage in a separate process.
+#   - A stage that raises is still recorded, with the exception in its 'error' field.
+#   - This file is used by both the Python 2 (fuzzy) and Python 3 jobs.
+# --------------------------------------------------------------------------------------------------
+import sys
+import time
+import json
+import logging
+import resource
+from contextlib import contextmanager
+
+
+# Stage records of the current process
+stage_records = []
+
+
+# Peak resident set size of the current process, in MB
+def get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024. * 1024.) if sys.platform == "darwin" else peak_rss / 1024.
+
+
+# JSON conversion of the field values that json cannot serialize (e.g. numpy scalars)
+def to_json_value(value):
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+# Stage timer
+@contextmanager
+def stage_timer(stage, logger=None, rows=None, level=logging.INFO, **fields):
+    """ Times the enclosed block and records its metrics.
+
+    Parameters:
+        stage: Stage name
+        logger: Logger object (if None, the stage is only recorded in stage_records)
+        rows: Number of rows processed by the stage; can also be set on the yielded record
+            (record['rows'] = ...) when it is only known at the end of the stage
+        level: Logging level of the stage record
+        fields: Additional fields to be reported (e.g. year=2017)
+
+    Yields:
+        The stage record (a dict), which holds the metrics after the block has completed (if the
+        block raises, the record also holds the exception in 'error' and the exception is re-raised)
+    """
+    record = {'stage': stage, 'rows': rows}
+    record.update(fields)
+    start = time.time()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = "{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        wall_seconds = time.time() - start
+        rows = record['rows']
+        record['rows'] = None if rows is None else int(rows)
+        record['wall_seconds'] = round(wall_seconds, 3)
+        record['peak_rss_mb'] = round(get_peak_rss_mb(), 1)
+        record['rows_per_second'] = None if rows is None else round(float(rows) / max(wall_seconds, 1e-6), 1)
+        stage_records.append(record)
+        if logger is not None:
+            logger.log(level, "[stage] {}".format(json.dumps(record, sort_keys=True, default=to_json_value)))
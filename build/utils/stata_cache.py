@@ -0,0 +1,118 @@
+# --------------------------------------------------------------------------------------------------
+# Stata_Cache
+#
+# This file provides a shared read layer for the Stata (.dta) inputs of the Python build jobs
+# (UP_Aggregation and Unwind_MF_Positions_Step1). Each .dta file is converted once into a columnar
+# Feather file, keyed by the source path, modification time, size and requested column set. Only the
+# requested columns are converted, so that a first (uncached) read does not use more memory than a
+# direct read. Subsequent reads are served from the memory-mapped Feather file; a cache of the full
+# file also serves reads of any column subset.
+#
+# Notes:
+#   - The cache requires pyarrow; if it is not available, files are read directly with pd.read_stata.
+#   - The cache is an intermediate format only; all deliverables are still written as .dta files.
+# --------------------------------------------------------------------------------------------------
+import os
+import time
+import hashlib
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+
+# Cache statistics for the current process
+cache_stats = {'hits': 0, 'misses': 0, 'uncached': 0, 'seconds': 0.}
+
+
+# Cache file location for a given .dta file and column set
+def get_cache_path(path, cache_dir, columns=None):
+    """ The cache key combines the absolute path, modification time (in nanoseconds) and size of the
+    source file, so that a modified .dta file is converted again on its next read, as well as the
+    set of requested columns ("all" for the full file).
+    """
+    stat = os.stat(path)
+    path_key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+    columns_key = "all" if columns is None else \
+        hashlib.sha1("\n".join(sorted(set(columns))).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, "{}_{}_{}_{}.feather".format(path_key, stat.st_mtime_ns, stat.st_size, columns_key))
+
+
+# Convert the requested columns of a .dta file to its Feather cache, removing stale versions of the same file
+def _convert_to_cache(path, cache_path, columns=None):
+    df = pd.read_stata(path, columns=columns)
+    tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+    feather.write_feather(df, tmp_path)
+    os.replace(tmp_path, cache_path)
+    path_key, mtime_key, size_key = os.path.basename(cache_path).split("_")[:3]
+    cache_dir = os.path.dirname(cache_path)
+    for fname in os.listdir(cache_dir):
+        if fname.startswith(path_key + "_") and fname.endswith(".feather") and \
+                fname.split("_")[1:3] != [mtime_key, size_key]:
+            try:
+                os.remove(os.path.join(cache_dir, fname))
+            except OSError:
+                pass
+    return df
+
+
+# Main read function
+def read_stata_cached(path, cache_dir, columns=None, logger=None):
+    """ Drop-in replacement for pd.read_stata(path, columns=columns) backed by a columnar cache.
+
+    Parameters:
+        path: Path to the .dta file
+        cache_dir: Cache folder; if None, the file is read directly with pd.read_stata
+        columns: Columns to be read in (all if None)
+        logger: Logger object
+
+    Returns:
+        A dataframe with the contents of the .dta file
+    """
+    start = time.time()
+
+    # Direct read if the cache is disabled or unavailable
+    if cache_dir is None or feather is None:
+        df = pd.read_stata(path, columns=columns)
+        status = "uncached"
+
+    else:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        full_cache_path = get_cache_path(path, cache_dir)
+        cache_path = full_cache_path if columns is None else get_cache_path(path, cache_dir, columns)
+
+        # Cache hit: memory-mapped read of the requested columns only
+        hit_path = full_cache_path if os.path.exists(full_cache_path) else cache_path
+        if os.path.exists(hit_path):
+            table = feather.read_table(hit_path, columns=None if columns is None else list(columns), memory_map=True)
+            df = (table if columns is None else table.select(list(columns))).to_pandas()
+            status = "hits"
+
+        # Cache miss: convert the requested columns only
+        else:
+            try:
+                df = _convert_to_cache(path, cache_path, columns)
+                status = "misses"
+            except Exception as e:
+                if logger is not None:
+                    logger.warning("Could not cache {} ({}); reading directly".format(path, e))
+                df = pd.read_stata(path, columns=columns)
+                status = "uncached"
+
+    elapsed = time.time() - start
+    cache_stats[status] += 1
+    cache_stats['seconds'] += elapsed
+    if logger is not None:
+        logger.info("Read {} ({} rows, {} columns) in {:.1f}s [{}]".format(
+            path, df.shape[0], df.shape[1], elapsed, {'hits': "cache hit", 'misses': "cache miss",
+            'uncached': "no cache"}[status]))
+    return df
+
+
+# Report cache statistics
+def log_cache_summary(logger):
+    logger.info("Stata cache: {} hits, {} misses, {} uncached reads, {:.1f}s total read time".format(
+        cache_stats['hits'], cache_stats['misses'], cache_stats['uncached'], cache_stats['seconds']))